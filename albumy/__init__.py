@@ -1,9 +1,10 @@
 import logging
 import os
+from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler, SMTPHandler
 
 import click
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, g
 from flask_login import current_user
 
 from .blueprints.admin import admin_bp
@@ -12,7 +13,7 @@ from .blueprints.auth import auth_bp
 from .blueprints.main import main_bp
 from .blueprints.user import user_bp
 from .extensions import db, mail, login_manager, bootstrap, migrate, moment, dropzone, csrf, avatars, toolbar, whooshee
-from .models import User, Role, Permission, Photo, Tag, Comment, Collect, Follow, Notification
+from .models import User, Role, Permission, Photo, Tag, Comment, Collect, Follow, Notification, Timeline, tagging
 
 
 def create_app(config_name=None):
@@ -28,6 +29,7 @@ def create_app(config_name=None):
     register_blueprints(app)
     register_shell_context(app)
     register_template_context(app)
+    register_request_handlers(app)
     register_errors(app)
     register_commends(app)
 
@@ -93,19 +95,28 @@ def register_shell_context(app=None):
     @app.shell_context_processor
     def shell_context():
         return dict(db=db, User=User, Role=Role, Permission=Permission, Photo=Photo, Tag=Tag, Comment=Comment,
-                    Collect=Collect, Follow=Follow)
+                    Collect=Collect, Follow=Follow, Timeline=Timeline)
 
 
 def register_template_context(app=None):
     @app.context_processor
     def make_template_context():
         if current_user.is_authenticated:
-            notification_count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
+            # 未读计数变化频繁, 不放在用户快照中, 每次按主键只查询这一列
+            notification_count = db.session.query(User.unread_notification_count). \
+                filter_by(id=current_user.id).scalar()
         else:
             notification_count = None
         return dict(notification_count=notification_count)
 
 
+def register_request_handlers(app=None):
+    @app.before_request
+    def reset_relations():
+        # 测试时多个请求共用一个应用上下文, 不能使用上一个请求查询的关系
+        g.pop('relations', None)
+
+
 def register_errors(app=None):
     @app.errorhandler(400)
     def bad_request(e):
@@ -206,6 +217,218 @@ def register_commends(app=None):
         db.session.commit()
         click.echo('完成!')
 
+    @app.cli.command()
+    @click.option('--workers', default=8, help='Quantity of threads moving files, default is 8')
+    @click.option('--batch-size', default=1000, help='Quantity of files moved per batch, default is 1000')
+    def shard_uploads(workers, batch_size):
+        """Move uploads and avatars into the sharded directory layout, safe to re-run after an interruption"""
+        from concurrent.futures import ThreadPoolExecutor
+        from functools import partial
+        from itertools import islice
+        from .storage import move_to_shard
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for base_path in [app.config['ALBUMY_UPLOAD_PATH'], app.config['AVATARS_SAVE_PATH']]:
+                if not os.path.isdir(base_path):
+                    continue
+                # 已经移动过的文件不在base_path下了, 中断之后重新执行只会处理剩下的文件
+                names = (entry.name for entry in os.scandir(base_path)
+                         if entry.is_file() and not entry.name.endswith('.tmp'))
+                moved = 0
+                batch = list(islice(names, batch_size))
+                while batch:
+                    moved += sum(executor.map(partial(move_to_shard, base_path), batch))
+                    click.echo('%s: %d files moved' % (base_path, moved))
+                    batch = list(islice(names, batch_size))
+        click.echo('Done!')
+
+    def backfill_photos(query, read, get_args, workers, batch_size):
+        """在进程池里用read(*get_args(photo))读取图片, 把返回的字段写回query中的每个Photo"""
+        from concurrent.futures import ProcessPoolExecutor
+
+        query = query.order_by(Photo.id)
+        updated = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            photos = query.limit(batch_size).all()
+            while photos:
+                futures = [executor.submit(read, *get_args(photo)) for photo in photos]
+                for photo, future in zip(photos, futures):
+                    try:
+                        data = future.result()
+                    except IOError:
+                        click.echo('%s: cannot read the photo' % photo.filename)
+                        continue
+                    for key, value in data.items():
+                        setattr(photo, key, value)
+                    updated += 1
+                db.session.commit()
+                click.echo('%d photos updated' % updated)
+                # 读取失败的记录仍然满足query的条件, 按id翻页避免重复处理
+                photos = query.filter(Photo.id > photos[-1].id).limit(batch_size).all()
+        click.echo('Done!')
+
+    @app.cli.command()
+    @click.option('--workers', default=4, help='Quantity of processes reading photos, default is 4')
+    @click.option('--batch-size', default=200, help='Quantity of photos updated per commit, default is 200')
+    def backfill_metadata(workers, batch_size):
+        """Fill in dimensions, file sizes and EXIF fields of photos uploaded before they were recorded"""
+        from .utils import read_photo_metadata
+
+        upload_path = app.config['ALBUMY_UPLOAD_PATH']
+        backfill_photos(Photo.query.filter(Photo.width.is_(None)), read_photo_metadata,
+                        lambda photo: (upload_path, photo.filename, photo.filename_m, photo.filename_s),
+                        workers, batch_size)
+
+    @app.cli.command()
+    @click.option('--workers', default=4, help='Quantity of processes reading photos, default is 4')
+    @click.option('--batch-size', default=200, help='Quantity of photos updated per commit, default is 200')
+    def backfill_placeholders(workers, batch_size):
+        """Compute the BlurHash and dominant colour placeholders of photos that have none"""
+        from .utils import read_photo_placeholder
+
+        upload_path = app.config['ALBUMY_UPLOAD_PATH']
+        backfill_photos(Photo.query.filter(Photo.blurhash.is_(None), Photo.processing.isnot(True)),
+                        read_photo_placeholder, lambda photo: (upload_path, photo.filename_s), workers, batch_size)
+
+    @app.cli.command()
+    @click.option('--workers', default=4, help='Quantity of processes reading photos, default is 4')
+    @click.option('--batch-size', default=1000, help='Quantity of photos hashed per batch, default is 1000')
+    def build_phash(workers, batch_size):
+        """Compute the perceptual hashes of photos that have none, hashing each batch at once with NumPy if installed"""
+        from concurrent.futures import ProcessPoolExecutor
+        from .phash import dhash_many
+        from .utils import read_dhash_pixels
+
+        upload_path = app.config['ALBUMY_UPLOAD_PATH']
+        query = Photo.query.filter(Photo.phash.is_(None)).order_by(Photo.id)
+        updated = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            photos = query.limit(batch_size).all()
+            while photos:
+                futures = [executor.submit(read_dhash_pixels, upload_path, photo.filename) for photo in photos]
+                readable, pixels = [], []
+                for photo, future in zip(photos, futures):
+                    try:
+                        pixels.append(future.result())
+                    except IOError:
+                        click.echo('%s: cannot read the photo' % photo.filename)
+                        continue
+                    readable.append(photo)
+                if readable:
+                    for photo, phash in zip(readable, dhash_many(pixels)):
+                        photo.phash = phash
+                    db.session.commit()
+                updated += len(readable)
+                click.echo('%d photos hashed' % updated)
+                photos = query.filter(Photo.id > photos[-1].id).limit(batch_size).all()
+        click.echo('Done!')
+
+    @app.cli.command()
+    def reconcile_counters():
+        """Recompute the denormalised counters from the rows they count and fix any drift"""
+        count = db.select([db.func.count()])
+        counters = [
+            (Photo, Photo.collect_count, count.where(Collect.collected_id == Photo.id)),
+            (Photo, Photo.comment_count, count.where(Comment.photo_id == Photo.id)),
+            (Tag, Tag.photo_count, count.select_from(tagging).where(tagging.c.tag_id == Tag.id)),
+            (User, User.follower_count, count.where(db.and_(Follow.followed_id == User.id,
+                                                            Follow.follower_id != User.id))),
+            (User, User.following_count, count.where(db.and_(Follow.follower_id == User.id,
+                                                             Follow.followed_id != User.id))),
+            (User, User.photo_count, count.where(Photo.author_id == User.id)),
+            (User, User.collection_count, count.where(Collect.collector_id == User.id)),
+            (User, User.unread_notification_count, count.where(db.and_(Notification.receiver_id == User.id,
+                                                                       db.not_(Notification.is_read)))),
+        ]
+        for model, column, query in counters:
+            query = query.as_scalar()
+            fixed = model.query.filter(db.func.coalesce(column, -1) != query). \
+                update({column: query}, synchronize_session=False)
+            click.echo('%s.%s: %d rows fixed' % (model.__tablename__, column.key, fixed))
+        db.session.commit()
+        click.echo('Done!')
+
+    @app.cli.group()
+    def notifications():
+        """Manage notifications"""
+
+    @notifications.command()
+    @click.option('--older-than', default=30, help='Delete read notifications older than this many days.')
+    @click.option('--batch-size', default=1000, help='Number of notifications deleted per transaction.')
+    def purge(older_than, batch_size):
+        """Delete old read notifications in batches"""
+        notification = Notification.__table__
+        cutoff = datetime.utcnow() - timedelta(days=older_than)
+        condition = db.and_(notification.c.timestamp < cutoff, notification.c.is_read == db.true())
+        # 只扫描截止时间之前的主键范围, 每批一个短事务, 不会长时间锁表
+        max_id = db.session.query(db.func.max(Notification.id)).filter(Notification.timestamp < cutoff).scalar()
+        deleted, last_id = 0, 0
+        while max_id is not None:
+            ids = [row[0] for row in db.session.execute(
+                db.select([notification.c.id]).where(db.and_(condition, notification.c.id > last_id,
+                                                             notification.c.id <= max_id)).
+                order_by(notification.c.id).limit(batch_size))]
+            if not ids:
+                break
+            deleted += db.session.execute(notification.delete().where(notification.c.id.in_(ids))).rowcount
+            db.session.commit()
+            click.echo('%d notifications deleted' % deleted)
+            last_id = ids[-1]
+        click.echo('Done!')
+
+    @app.cli.command()
+    @click.option('--batch-size', default=1000, help='Number of users rebuilt per transaction.')
+    def rebuild_timeline(batch_size):
+        """Rebuild every user's home timeline from follows and photos"""
+        timeline, follow, photo, user = Timeline.__table__, Follow.__table__, Photo.__table__, User.__table__
+        limit = app.config['ALBUMY_TIMELINE_FANOUT_LIMIT']
+        # 按当前的粉丝数重新标记celebrity, 和update_celebrity的标记条件相同
+        # 重建会写入所有没有标记的用户的图片, 不需要再补齐
+        User.query.update({User.celebrity: db.func.coalesce(User.follower_count, 0) > limit,
+                           User.timeline_backfill: False}, synchronize_session=False)
+        db.session.commit()
+        created = 0
+        ids = [row[0] for row in db.session.query(User.id).order_by(User.id).limit(batch_size)]
+        while ids:
+            select = db.select([follow.c.follower_id, photo.c.id, photo.c.timestamp]). \
+                select_from(follow.join(photo, photo.c.author_id == follow.c.followed_id).
+                            join(user, user.c.id == follow.c.followed_id)). \
+                where(db.and_(follow.c.follower_id.in_(ids), user.c.celebrity == db.false()))
+            db.session.execute(timeline.delete().where(timeline.c.user_id.in_(ids)))
+            created += db.session.execute(
+                timeline.insert().from_select(['user_id', 'photo_id', 'timestamp'], select)).rowcount
+            db.session.commit()
+            click.echo('%d timeline rows created' % created)
+            ids = [row[0] for row in db.session.query(User.id).filter(User.id > ids[-1]).order_by(User.id).
+                   limit(batch_size)]
+        click.echo('Done!')
+
+    @app.cli.command()
+    @click.option('--batch-size', default=1000, help='Number of followers backfilled per transaction.')
+    def backfill_timeline(batch_size):
+        """Write the photos of former celebrities into their followers' timelines"""
+        timeline, follow, photo = Timeline.__table__, Follow.__table__, Photo.__table__
+        authors = db.session.query(User.id, User.username).filter(User.timeline_backfill == db.true()).all()
+        for author_id, username in authors:
+            created = 0
+            query = db.session.query(Follow.follower_id).filter(Follow.followed_id == author_id). \
+                order_by(Follow.follower_id)
+            ids = [row[0] for row in query.limit(batch_size)]
+            while ids:
+                select = db.select([follow.c.follower_id, photo.c.id, photo.c.timestamp]). \
+                    select_from(follow.join(photo, photo.c.author_id == follow.c.followed_id)). \
+                    where(db.and_(follow.c.followed_id == author_id, follow.c.follower_id.in_(ids),
+                                  ~db.exists().where(db.and_(timeline.c.user_id == follow.c.follower_id,
+                                                             timeline.c.photo_id == photo.c.id))))
+                created += db.session.execute(
+                    timeline.insert().from_select(['user_id', 'photo_id', 'timestamp'], select)).rowcount
+                db.session.commit()
+                ids = [row[0] for row in query.filter(Follow.follower_id > ids[-1]).limit(batch_size)]
+            User.query.filter_by(id=author_id).update({User.timeline_backfill: False}, synchronize_session=False)
+            db.session.commit()
+            click.echo('%s: %d timeline rows created' % (username, created))
+        click.echo('Done!')
+
     @app.cli.command()
     @click.option('--user', default=6, help='Quantity of users, default is 6')
     @click.option('--photo', default=30, help='Quantity of photo, default is 30')
@@ -137,6 +137,14 @@ def manage_photo(order):
     return render_template('admin/manage_photo.jinja2', pagination=pagination, photos=photos, order_rule=order_rule)
 
 
+@admin_bp.route('/manage/photo/<int:photo_id>/similar')
+@login_required
+@permission_required('MODERATE')
+def similar_photos(photo_id):
+    photo = Photo.query.get_or_404(photo_id)
+    return render_template('admin/similar_photos.jinja2', photo=photo, photos=photo.similar_photos())
+
+
 @admin_bp.route('/manage/user')
 @login_required
 @permission_required('MODERATE')
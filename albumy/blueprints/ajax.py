@@ -1,7 +1,8 @@
-from flask import Blueprint, render_template, jsonify
+from flask import Blueprint, render_template, jsonify, url_for
 from flask_login import current_user
 
-from ..models import User, Notification, Photo
+from ..extensions import db
+from ..models import User, Photo
 from ..notifications import push_follow_notification
 
 ajax_bp = Blueprint('ajax', __name__, )
@@ -26,9 +27,10 @@ def follow(username):
     if current_user.is_following(user):
         return jsonify(message='重复的操作, 以关注用户'), 400
 
-    current_user.follow(user)
+    # 消息和关注在同一次提交中写入
     if user.receive_follow_notification:
         push_follow_notification(current_user, user)
+    current_user.follow(user)
     return jsonify(message='已关注用户')
 
 
@@ -48,7 +50,7 @@ def unfollow(username):
 @ajax_bp.route('/followers-count/<int:user_id>')
 def followers_count(user_id):
     user = User.query.get_or_404(user_id)
-    count = user.followers.count() - 1
+    count = user.follower_count
     return jsonify(count=count)
 
 
@@ -56,7 +58,7 @@ def followers_count(user_id):
 def notifications_count():
     if not current_user.is_authenticated:
         return jsonify(message='用户未登录'), 401
-    count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
+    count = db.session.query(User.unread_notification_count).filter_by(id=current_user.id).scalar()
     return jsonify(count=count)
 
 
@@ -90,5 +92,13 @@ def uncollect(photo_id):
 @ajax_bp.route('/<int:photo_id>/collectors-count')
 def collectors_count(photo_id):
     photo = Photo.query.get_or_404(photo_id)
-    count = len(photo.collectors)
+    count = photo.collect_count
     return jsonify(count=count)
+
+
+@ajax_bp.route('/<int:photo_id>/status')
+def photo_status(photo_id):
+    photo = Photo.query.get_or_404(photo_id)
+    return jsonify(processing=photo.processing,
+                   filename_m=url_for('main.get_image', filename=photo.filename_m),
+                   filename_s=url_for('main.get_image', filename=photo.filename_s))
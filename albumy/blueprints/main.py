@@ -1,12 +1,17 @@
-from flask import Blueprint, render_template, request, current_app, send_from_directory, flash, redirect, url_for, abort
+from flask import Blueprint, render_template, request, current_app, flash, redirect, url_for, abort
 from flask_login import login_required, current_user
 
 from ..decorators import confirm_required, permission_required
 from ..extensions import db
 from ..forms.main import DescriptionForm, TagForm, CommentForm
-from ..models import Photo, Tag, Comment, Collect, Notification, Follow, User
-from ..notifications import push_collect_notification, push_commit_notification
-from ..utils import flash_errors, redirect_back, validate_image
+from ..models import Photo, Tag, Comment, Collect, Notification, User, Timeline, photo_card_options, \
+    prefetch_relations
+from ..notifications import push_collect_notification, push_commit_notification, read_all_notifications
+from ..pagination import KeysetPagination
+from ..sampling import random_sample
+from ..tasks import submit_thumbnails
+from ..utils import flash_errors, redirect_back, validate_image, send_image, send_resized_image, \
+    send_negotiated_image
 
 main_bp = Blueprint('main', __name__)
 
@@ -14,25 +19,22 @@ main_bp = Blueprint('main', __name__)
 @main_bp.route('/')
 def index():
     if current_user.is_authenticated:
-        page = request.args.get('page', 1, int)
         per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-        pagination = Photo.query. \
-            join(Follow, Follow.followed_id == Photo.author_id). \
-            filter(Follow.follower_id == current_user.id). \
-            order_by(Photo.timestamp.desc()). \
-            paginate(page, per_page)
+        pagination = Timeline.feed(current_user, per_page, request.args.get('cursor'))
         photos = pagination.items
+        prefetch_relations(photos=photos)
     else:
         pagination = None
         photos = None
-    tags = Tag.query.join(Tag.photos).group_by(Tag.id).order_by(db.func.count().desc()).limit(10)
+    tags = Tag.popular()
     return render_template('main/index.jinja2', pagination=pagination, photos=photos, tags=tags)
 
 
 @main_bp.route('/explore')
 def explore():
-    photos = Photo.query.order_by(db.func.random()).limit(12)
-    return render_template('main/explore.jinja2', photos=photos)
+    photos, cursor = random_sample(Photo.query.options(*photo_card_options()), Photo.id,
+                                   current_app.config['ALBUMY_PHOTO_PER_PAGE'], request.args.get('cursor'))
+    return render_template('main/explore.jinja2', photos=photos, cursor=cursor)
 
 
 @main_bp.route('/upload', methods=['GET', 'POST'])
@@ -42,28 +44,45 @@ def explore():
 def upload():
     if request.method == 'POST' and 'file' in request.files:
         f = request.files.get('file')
-        result = validate_image(f)
-        if result is None:
+        image = validate_image(f)
+        if image is None:
             return '不支持的图片格式', 400
-        photo = Photo(
-            filename=result['name'],
-            filename_m=result['name_m'],
-            filename_s=result['name_s'],
-            author=current_user._get_current_object()
-        )
+        # 相同的图片已经上传过时直接使用已有的缩略图, 否则在缩略图生成之前先用原图代替
+        same = Photo.query.filter_by(filename=image['filename']).first()
+        photo = Photo(author=current_user._get_current_object(), **image)
+        if same is None:
+            photo.filename_m = photo.filename_s = photo.filename
+            photo.filesize_m = photo.filesize_s = photo.filesize
+            photo.processing = True
+        else:
+            photo.filename_m, photo.filesize_m = same.filename_m, same.filesize_m
+            photo.filename_s, photo.filesize_s = same.filename_s, same.filesize_s
+            photo.blurhash, photo.color = same.blurhash, same.color
+            photo.processing = same.processing
         db.session.add(photo)
         db.session.commit()
+        if same is None:
+            submit_thumbnails(photo)
+        if current_app.config['ALBUMY_WARN_SIMILAR_UPLOADS'] and photo.similar_photos():
+            flash('上传的图片和已有的图片非常相似', 'warning')
+        # dropzone不显示返回的页面, 提示信息留到下一次打开页面时显示
+        return '上传成功'
     return render_template('main/upload.jinja2')
 
 
 @main_bp.route('/avatars/<path:filename>')
 def get_avatar(filename):
-    return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], filename)
+    return send_image(current_app.config['AVATARS_SAVE_PATH'], filename)
 
 
 @main_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+    return send_negotiated_image(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+
+
+@main_bp.route('/uploads/<path:filename>/w/<int:width>')
+def get_resized_image(filename, width):
+    return send_resized_image(filename, width)
 
 
 @main_bp.route('/photo/<int:photo_id>')
@@ -71,7 +90,7 @@ def show_photo(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(photo).order_by(Comment.timestamp.desc()).paginate(page, per_page)
+    pagination = Comment.thread_page(photo, page, per_page)
     comments = pagination.items
 
     description_form = DescriptionForm()
@@ -190,7 +209,7 @@ def delete_tag(photo_id, tag_id):
     photo.tags.remove(tag)
     db.session.commit()
 
-    if not tag.photos:
+    if not tag.photo_count:
         db.session.delete(tag)
         db.session.commit()
 
@@ -202,15 +221,15 @@ def delete_tag(photo_id, tag_id):
 @main_bp.route('/tag/<int:tag_id>/<any(by_time, by_collects):order>')
 def show_tag(tag_id, order):
     tag = Tag.query.get_or_404(tag_id)
-    page = request.args.get('page', 1, int)
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
     order_rule = '时间'
-    pagination = Photo.query.with_parent(tag).order_by(Photo.timestamp.desc()).paginate(page, per_page)
-    photos = pagination.items
-
+    columns = (Photo.timestamp, Photo.id)
     if order == 'by_collects':
         order_rule = '收藏量'
-        photos.sort(key=lambda x: len(x.collectors), reverse=True)
+        columns = (Photo.collect_count, Photo.id)
+    query = Photo.query.with_parent(tag).options(*photo_card_options())
+    pagination = KeysetPagination(query, columns, per_page, request.args.get('cursor'))
+    photos = pagination.items
     return render_template('main/tag.jinja2', tag=tag, pagination=pagination, photos=photos, order_rule=order_rule)
 
 
@@ -240,18 +259,20 @@ def new_comment(photo_id):
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data)
-        comment.author = current_user._get_current_object()
-        comment.photo = photo
-
+        # 先设置被回复的评论, 加入session之后查询会自动flush, 评论会先按顶层评论插入
         replied_id = request.args.get('reply')
         if replied_id:
             comment.replied = Comment.query.get_or_404(replied_id)
+        comment.author = current_user._get_current_object()
+        comment.photo = photo
         db.session.add(comment)
-        db.session.commit()
         if photo.author.receive_comment_notification:
-            push_commit_notification(photo_id, photo.author, page=1)
+            push_commit_notification(comment, photo.author)
+        db.session.commit()
         flash('已评论', 'success')
-        return redirect(url_for('.show_photo', photo_id=photo_id, page=1))
+        # 回复显示在讨论串中, 不一定在第一页
+        page = comment.page(current_app.config['ALBUMY_COMMENT_PER_PAGE'])
+        return redirect(url_for('.show_photo', photo_id=photo_id, page=page))
     flash_errors(form)
     return redirect(url_for('.show_photo', photo_id=photo_id, page=page))
 
@@ -297,9 +318,10 @@ def collect(photo_id):
     if current_user.is_collecting(photo):
         flash('当前图片已经收藏', 'info')
         return redirect(url_for('.show_photo', photo_id=photo_id))
-    current_user.collect(photo)
+    # 消息和收藏在同一次提交中写入
     if photo.author.receive_collect_notification:
         push_collect_notification(current_user, photo_id, photo.author)
+    current_user.collect(photo)
     flash('收藏成功!', 'success')
     return redirect(url_for('.show_photo', photo_id=photo_id))
 
@@ -323,19 +345,23 @@ def show_collectors(photo_id):
     per_page = current_app.config['ALBUMY_USER_PER_PAGE']
     pagination = Collect.query.with_parent(photo).order_by(Collect.timestamp.asc()).paginate(page, per_page)
     collects = pagination.items
+    prefetch_relations(users=[collect.collector for collect in collects])
     return render_template('main/collectors.jinja2', collects=collects, photo=photo, pagination=pagination)
 
 
 @main_bp.route('/notifications')
 @login_required
 def show_notifications():
-    page = request.args.get('page', 1, int)
+    cursor = request.args.get('cursor')
     per_page = current_app.config['ALBUMY_NOTIFICATION_PER_PAGE']
-    notifications = Notification.query.with_parent(current_user)
+    # 显示时需要的用户和图片用IN一次查出
+    notifications = Notification.query.with_parent(current_user).options(
+        db.selectinload(Notification.actor).load_only('username'),
+        db.selectinload(Notification.photo).load_only('id'))
     filter_rule = request.args.get('filter')
     if filter_rule == 'unread':
         notifications = notifications.filter_by(is_read=False)
-    pagination = notifications.order_by(Notification.timestamp.desc()).paginate(page, per_page)
+    pagination = KeysetPagination(notifications, (Notification.timestamp, Notification.id), per_page, cursor)
     notifications = pagination.items
     return render_template('main/notifications.jinja2', pagination=pagination, notifications=notifications)
 
@@ -356,10 +382,7 @@ def read_notification(notification_id):
 @main_bp.route('/notifications/read/all', methods=['POST'])
 @login_required
 def read_all_notification():
-    notifications = Notification.query.with_parent(current_user).all()
-    for notification in notifications:
-        notification.is_read = True
-    db.session.commit()
+    read_all_notifications(current_user)
     flash('全部消息已读', 'success')
     return redirect_back()
 
@@ -379,6 +402,8 @@ def search():
     elif category == 'tag':
         pagination = Tag.query.whooshee_search(q).paginate(page, per_page)
     else:
-        pagination = Photo.query.whooshee_search(q).paginate(page, per_page)
+        pagination = Photo.query.whooshee_search(q).options(*photo_card_options()).paginate(page, per_page)
     results = pagination.items
+    if category == 'user':
+        prefetch_relations(users=results)
     return render_template('main/search.jinja2', q=q, results=results, pagination=pagination, category=category)
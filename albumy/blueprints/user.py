@@ -6,9 +6,11 @@ from ..emails import send_change_email
 from ..extensions import db, avatars
 from ..forms.user import EditProfileForm, UploadAvatarForm, CropAvatarForm, ChangePasswordForm, ChangeEmailForm, \
     NotificationSettingForm, PrivacySettingForm, DeleteAccountForm
-from ..models import User, Photo, Collect
+from ..models import User, Photo, Collect, photo_card_options, prefetch_relations
 from ..notifications import push_follow_notification
+from ..pagination import KeysetPagination
 from ..settings import Operations
+from ..storage import locate_file, move_to_shard
 from ..utils import redirect_back, flash_errors, generate_token, validate_token
 
 user_bp = Blueprint('user', __name__)
@@ -21,9 +23,10 @@ def index(username):
         flash('该帐户被锁定了.', 'danger')
     if user == current_user and not user.active:
         logout_user()
-    page = request.args.get('page', 1, int)
+    cursor = request.args.get('cursor')
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-    pagination = Photo.query.with_parent(user).order_by(Photo.timestamp.desc()).paginate(page, per_page)
+    pagination = KeysetPagination(Photo.query.with_parent(user).options(*photo_card_options()),
+                                  (Photo.timestamp, Photo.id), per_page, cursor)
     photos = pagination.items
     return render_template('user/index.jinja2', user=user, pagination=pagination, photos=photos)
 
@@ -47,10 +50,10 @@ def follow(username):
     if current_user.is_following(user):
         flash('重复操作, 已关注该用户', 'info')
         return redirect(url_for('.index', username=username))
-    current_user.follow(user)
-    db.session.commit()
+    # 消息和关注在同一次提交中写入
     if user.receive_follow_notification:
         push_follow_notification(current_user, user)
+    current_user.follow(user)
     flash('关注成功', 'success')
     return redirect_back()
 
@@ -75,6 +78,7 @@ def show_followers(username):
     per_page = current_app.config['ALBUMY_USER_PER_PAGE']
     pagination = user.followers.paginate(page, per_page)
     follows = pagination.items
+    prefetch_relations(users=[follow.follower for follow in follows])
     return render_template('user/followers.jinja2', user=user, pagination=pagination, follows=follows)
 
 
@@ -85,6 +89,7 @@ def show_following(username):
     per_page = current_app.config['ALBUMY_USER_PER_PAGE']
     pagination = user.following.paginate(page, per_page)
     follows = pagination.items
+    prefetch_relations(users=[follow.followed for follow in follows])
     return render_template('user/followings.jinja2', user=user, pagination=pagination, follows=follows)
 
 
@@ -126,6 +131,7 @@ def upload_avatar():
     if form.validate_on_submit():
         image = form.image.data
         filename = avatars.save_avatar(image)
+        move_to_shard(current_app.config['AVATARS_SAVE_PATH'], filename)
         current_user.avatar_raw = filename
         db.session.commit()
         flash('头像上传成功', 'success')
@@ -143,7 +149,11 @@ def crop_avatar():
         y = form.y.data
         w = form.w.data
         h = form.h.data
-        filenames = avatars.crop_avatar(current_user.avatar_raw, x, y, w, h)
+        path = current_app.config['AVATARS_SAVE_PATH']
+        raw = current_user.avatar_raw
+        filenames = avatars.crop_avatar(locate_file(path, raw) if raw else raw, x, y, w, h)
+        for filename in filenames:
+            move_to_shard(path, filename)
         current_user.avatar_s = filenames[0]
         current_user.avatar_m = filenames[1]
         current_user.avatar_l = filenames[2]
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from flask import current_app
+
+from .storage import shard_path
+
+try:
+    import fcntl
+except ImportError:  # Windows上没有fcntl, 只在进程内加锁
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    """进程间的排它锁. flock锁在打开的文件上, 同一进程中各自打开文件的线程之间也互相排斥"""
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield f
+
+
+class DiskCache:
+    """按需生成的文件的磁盘缓存.
+
+    文件保存在ALBUMY_RENDITION_PATH下, 总大小超过ALBUMY_RENDITION_CACHE_SIZE时按修改时间删除最久没有
+    被访问的文件(命中时会更新修改时间). 同一个文件同时只生成一次, 其它请求等待生成完成后直接使用.
+    锁和总大小都保存在缓存目录中以.开头的文件里, 多个进程共用同一个目录时也只生成一次, 并共用大小的上限.
+    """
+
+    def __init__(self, stripes=64):
+        # 按文件名分段加锁, 不需要为每个文件单独保存一把锁
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._sizes_lock = threading.Lock()
+
+    def lookup(self, name):
+        """缓存文件存在时返回它的绝对路径并更新修改时间, 否则返回None"""
+        path = os.path.join(current_app.config['ALBUMY_RENDITION_PATH'], shard_path(name))
+        return path if self._touch(path) else None
+
+    def get(self, name, render):
+        """返回缓存文件的绝对路径, 文件不存在时调用render(path)生成"""
+        base_path = current_app.config['ALBUMY_RENDITION_PATH']
+        path = os.path.join(base_path, shard_path(name))
+        if self._touch(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stripe = zlib.crc32(name.encode('utf-8')) % len(self._locks)
+        with self._locks[stripe], file_lock(os.path.join(base_path, '.lock-%d' % stripe)):
+            # 等待锁的时候其它线程或进程可能已经生成好了
+            if self._touch(path):
+                return path
+            tmp_path = os.path.join(os.path.dirname(path), '.%d-%s' % (os.getpid(), name))
+            try:
+                render(tmp_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            os.replace(tmp_path, path)
+        self._add(base_path, os.path.getsize(path))
+        return path
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    @staticmethod
+    def _scan(base_path):
+        for root, _, files in os.walk(base_path):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, path, stat.st_size
+
+    def _add(self, base_path, size):
+        limit = current_app.config['ALBUMY_RENDITION_CACHE_SIZE']
+        # 总大小保存在.size文件中, 所有进程在同一把锁下累加
+        with self._sizes_lock, file_lock(os.path.join(base_path, '.size')) as f:
+            f.seek(0)
+            value = f.read()
+            if value:
+                total = int(value) + size
+            else:
+                # 第一次写入时统计一次目录的大小, 之后只累加新文件
+                total = sum(item[2] for item in self._scan(base_path))
+            if total > limit:
+                total = self._evict(base_path, limit)
+            f.seek(0)
+            f.truncate()
+            f.write(str(total))
+
+    def _evict(self, base_path, limit):
+        files = sorted(self._scan(base_path))
+        total = sum(item[2] for item in files)
+        # 多删除一些, 避免每次写入都要重新扫描目录
+        target = limit * 0.9
+        for _, path, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+class MemoryCache:
+    """进程内的缓存, 值在timeout秒后过期, 数据修改时用delete立即失效"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        # delete之后, 已经开始的get不会再写入旧的值
+        self._generations = {}
+
+    def get(self, key, load, timeout):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._values.get(key)
+            generation = self._generations.get(key, 0)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = load()
+        with self._lock:
+            if self._generations.get(key, 0) == generation:
+                self._values[key] = (now + timeout, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            for key in self._values:
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._values.clear()
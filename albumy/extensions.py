@@ -11,6 +11,8 @@ from flask_whooshee import Whooshee
 from flask_wtf.csrf import CSRFProtect
 from sqlalchemy import MetaData
 
+from .cache import DiskCache, MemoryCache
+
 convention = {
     "ix": 'ix_%(column_0_label)s',
     "uq": "uq_%(column_0_label)s",
@@ -29,12 +31,14 @@ csrf = CSRFProtect()
 avatars = Avatars()
 toolbar = DebugToolbarExtension()
 whooshee = Whooshee()
+rendition_cache = DiskCache()
+memory_cache = MemoryCache()
 
 
 @login_manager.user_loader
 def load_user(user_id):
     from .models import User
-    user = User.query.get(int(user_id))
+    user = User.get_cached(int(user_id))
     return user
 
 
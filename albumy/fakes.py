@@ -8,6 +8,7 @@ from sqlalchemy.exc import IntegrityError
 
 from .extensions import db
 from .models import User, Photo, Tag, Comment
+from .storage import storage_path
 
 fake = Faker('zh_CN')
 
@@ -53,11 +54,14 @@ def fake_photos(count=30):
         filename = 'random_%s.jpg' % i
         r = lambda: random.randint(10, 255)
         img = Image.new('RGB', (800, 800), (r(), r(), r()))
-        img.save(os.path.join(upload_path, filename))
+        img.save(storage_path(upload_path, filename))
         photo = Photo(
             filename=filename,
             filename_m=filename,
             filename_s=filename,
+            width=800,
+            height=800,
+            format='JPEG',
             description=fake.text(),
             timestamp=fake.date_time_this_year()
         )
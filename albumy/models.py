@@ -1,13 +1,77 @@
-import os
+from collections import namedtuple
 from datetime import datetime
 
-from flask import current_app
+from flask import current_app, g, abort
 from flask_avatars import Identicon
-from flask_login import UserMixin
+from flask_login import UserMixin, current_user
+from flask_sqlalchemy import Pagination
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.util import symbol
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from .extensions import db, whooshee
+from .extensions import db, whooshee, memory_cache
+from .pagination import KeysetPagination
+from .phash import BANDS, split_hash, hamming
+from .storage import remove_file, remove_image, move_to_shard
+
+
+class Relations:
+    """一个用户在一次请求中和图片, 其它用户的关系.
+
+    列表页面先用prefetch_relations登记这一页的图片和用户, 第一次询问某种关系时用一条IN查询
+    查出所有登记过的对象, 之后的询问都只是查集合. 关系保存在g中, 只在当前请求内有效.
+    """
+
+    names = ('collecting', 'following', 'followed_by')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._pending = {name: set() for name in self.names}
+        self._checked = {name: set() for name in self.names}
+        self._found = {name: set() for name in self.names}
+
+    def _query(self, name, ids):
+        # 只查询关系另一端的id, 不会加载Collect和Follow上lazy='joined'的关系
+        if name == 'collecting':
+            return db.session.query(Collect.collected_id).filter(Collect.collector_id == self.user_id,
+                                                                 Collect.collected_id.in_(ids))
+        if name == 'following':
+            return db.session.query(Follow.followed_id).filter(Follow.follower_id == self.user_id,
+                                                               Follow.followed_id.in_(ids))
+        return db.session.query(Follow.follower_id).filter(Follow.followed_id == self.user_id,
+                                                           Follow.follower_id.in_(ids))
+
+    def prefetch(self, photos=(), users=()):
+        self._pending['collecting'].update(photo.id for photo in photos)
+        for name in ('following', 'followed_by'):
+            self._pending[name].update(user.id for user in users)
+
+    def check(self, name, target_id):
+        if target_id not in self._checked[name]:
+            ids = (self._pending[name] - self._checked[name]) | {target_id}
+            self._found[name].update(row[0] for row in self._query(name, ids))
+            self._checked[name].update(ids)
+            self._pending[name].clear()
+        return target_id in self._found[name]
+
+    def update(self, name, target_id, value):
+        self._checked[name].add(target_id)
+        if value:
+            self._found[name].add(target_id)
+        else:
+            self._found[name].discard(target_id)
+
+
+def prefetch_relations(photos=(), users=()):
+    """登记当前页面上的图片和用户, 模板中的is_collecting, is_following和is_followed_by不再逐个查询"""
+    if current_user.is_authenticated:
+        current_user.relations.prefetch(photos, users)
+
+
+# 登录用户在每个请求中都会用到的字段, 缓存在内存中, 其它字段在访问时才从数据库加载
+USER_SNAPSHOT_FIELDS = ('id', 'username', 'name', 'role_id', 'active', 'locked', 'confirmed',
+                        'avatar_raw', 'avatar_s', 'avatar_m', 'avatar_l')
 
 
 @whooshee.register_model('name', 'username')
@@ -32,6 +96,18 @@ class User(db.Model, UserMixin):
     public_collections = db.Column(db.Boolean, default=True)
     locked = db.Column(db.Boolean, default=False)
     active = db.Column(db.Boolean, default=True)
+    # 由Follow的事件维护, 不包括关注自己
+    follower_count = db.Column(db.Integer, default=0)
+    following_count = db.Column(db.Integer, default=0)
+    # 粉丝太多, 新图片不写入粉丝的时间线, 由update_celebrity维护
+    celebrity = db.Column(db.Boolean, default=False)
+    # 取消celebrity标记之后, 标记期间的图片还没有补到粉丝的时间线里, 由backfill-timeline命令分批补齐
+    timeline_backfill = db.Column(db.Boolean, default=False)
+    # 由Photo和Collect的事件维护
+    photo_count = db.Column(db.Integer, default=0)
+    collection_count = db.Column(db.Integer, default=0)
+    # 由Notification的事件维护
+    unread_notification_count = db.Column(db.Integer, default=0)
 
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
     role = db.relationship('Role', back_populates='users')
@@ -42,7 +118,8 @@ class User(db.Model, UserMixin):
                                 cascade='all', lazy='dynamic')
     followers = db.relationship('Follow', back_populates='followed', foreign_keys='[Follow.followed_id]',
                                 cascade='all', lazy='dynamic')
-    notifications = db.relationship('Notification', back_populates='receiver', cascade='all')
+    notifications = db.relationship('Notification', back_populates='receiver', cascade='all',
+                                    foreign_keys='[Notification.receiver_id]')
 
     def __init__(self, *args, **kwargs):
         super(User, self).__init__(*args, **kwargs)
@@ -53,6 +130,8 @@ class User(db.Model, UserMixin):
     def generate_avatar(self):
         avatar = Identicon()
         filenames = avatar.generate(self.name)
+        for filename in filenames:
+            move_to_shard(current_app.config['AVATARS_SAVE_PATH'], filename)
         self.avatar_s = filenames[0]
         self.avatar_m = filenames[1]
         self.avatar_l = filenames[2]
@@ -60,54 +139,91 @@ class User(db.Model, UserMixin):
     def set_role(self):
         if self.role is None:
             if self.email == current_app.config['ALBUMY_ADMIN_EMAIL']:
-                self.role = Role.query.filter_by(name='Administrator').first()
+                self.role = Role.get_by_name('Administrator')
             else:
-                self.role = Role.query.filter_by(name='Normal').first()
+                self.role = Role.get_by_name('Normal')
+
+    @staticmethod
+    def get_cached(user_id):
+        """按id返回用户, 从缓存的快照中恢复USER_SNAPSHOT_FIELDS, 不查询数据库. 快照中的字段在提交修改后失效"""
+        user = db.session.identity_map.get(db.inspect(User).identity_key_from_primary_key((user_id,)))
+        if user is not None:
+            return user
+
+        def load():
+            row = db.session.query(*[getattr(User, name) for name in USER_SNAPSHOT_FIELDS]). \
+                filter(User.id == user_id).first()
+            return row._asdict() if row is not None else None
+        snapshot = memory_cache.get('user:%d' % user_id, load, current_app.config['ALBUMY_USER_CACHE_TIMEOUT'])
+        if snapshot is None:
+            return None
+        user = db.inspect(User).class_manager.new_instance()
+        for name, value in snapshot.items():
+            set_committed_value(user, name, value)
+        # 没有恢复的字段处于过期状态, 第一次访问时一次加载
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @property
+    def relations(self):
+        """当前请求中和这个用户有关的关系, 见Relations"""
+        cache = g.setdefault('relations', {})
+        if self.id not in cache:
+            cache[self.id] = Relations(self.id)
+        return cache[self.id]
 
     def collect(self, photo):
         if not self.is_collecting(photo):
             collect = Collect(collector=self, collected=photo)
             db.session.add(collect)
             db.session.commit()
+            self.relations.update('collecting', photo.id, True)
 
     def uncollect(self, photo):
         collect = Collect.query.with_parent(self).filter_by(collected_id=photo.id).first()
         if collect:
             db.session.delete(collect)
             db.session.commit()
+        self.relations.update('collecting', photo.id, False)
 
     def is_collecting(self, photo):
-        return Collect.query.with_parent(self).filter_by(collected_id=photo.id).first() is not None
+        return self.relations.check('collecting', photo.id)
 
     def is_followed_by(self, user):
-        return self.followers.filter_by(follower_id=user.id).first() is not None
+        if self.id is None or user.id is None:
+            return False
+        return self.relations.check('followed_by', user.id)
 
     def is_following(self, user):
-        if user.id is None:
+        if self.id is None or user.id is None:
             return False
-        return self.following.filter_by(followed_id=user.id).first() is not None
+        return self.relations.check('following', user.id)
 
     def follow(self, user):
         if not self.is_following(user):
             follow = Follow(follower=self, followed=user)
             db.session.add(follow)
             db.session.commit()
+            self.relations.update('following', user.id, True)
+            user.relations.update('followed_by', self.id, True)
 
     def unfollow(self, user):
         follow = Follow.query.filter(Follow.follower == self, Follow.followed == user).first()
         if follow:
             db.session.delete(follow)
             db.session.commit()
+        self.relations.update('following', user.id, False)
+        user.relations.update('followed_by', self.id, False)
 
     def lock(self):
         if not self.is_admin:
             self.locked = True
-            self.role = Role.query.filter_by(name='Locked').first()
+            self.role = Role.get_by_name('Locked')
             db.session.commit()
 
     def unlock(self):
         self.locked = False
-        self.role = Role.query.filter_by(name='Normal').first()
+        self.role = Role.get_by_name('Normal')
         db.session.commit()
 
     @property
@@ -125,11 +241,12 @@ class User(db.Model, UserMixin):
 
     @property
     def is_admin(self):
-        return self.role.name == 'Administrator'
+        return self.role_id is not None and self.role_id == Role.masks().ids.get('Administrator')
 
     def can(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and self.role is not None and permission in self.role.permissions
+        masks = Role.masks()
+        bit = masks.permissions.get(permission_name)
+        return bit is not None and masks.roles.get(self.role_id, 0) & bit != 0
 
     @property
     def password(self):
@@ -146,6 +263,10 @@ class User(db.Model, UserMixin):
         return '<User %r>' % self.username
 
 
+# 编译好的角色和权限: permissions是权限名到位的映射, roles是角色id到权限位掩码的映射, ids是角色名到角色id的映射
+RoleMasks = namedtuple('RoleMasks', ['permissions', 'roles', 'ids'])
+
+
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), unique=True)
@@ -176,6 +297,26 @@ class Role(db.Model):
                 role.permissions.append(permission)
         db.session.commit()
 
+    @staticmethod
+    def masks():
+        """返回所有角色的权限位掩码, 角色或权限修改后在提交时失效"""
+        def load():
+            permissions = {name: 1 << i for i, (name,) in
+                           enumerate(db.session.query(Permission.name).order_by(Permission.id))}
+            roles, ids = {}, {}
+            for role_id, name in db.session.query(Role.id, Role.name):
+                roles[role_id], ids[name] = 0, role_id
+            for role_id, name in db.session.query(roles_permissions.c.role_id, Permission.name). \
+                    join(Permission, Permission.id == roles_permissions.c.permission_id):
+                roles[role_id] = roles.get(role_id, 0) | permissions[name]
+            return RoleMasks(permissions, roles, ids)
+        return memory_cache.get('roles', load, current_app.config['ALBUMY_ROLE_CACHE_TIMEOUT'])
+
+    @staticmethod
+    def get_by_name(name):
+        role_id = Role.masks().ids.get(name)
+        return Role.query.get(role_id) if role_id is not None else None
+
     def __repr__(self):
         return '<Role %r>' % self.name
 
@@ -196,38 +337,120 @@ roles_permissions = db.Table('roles_permissions',
 
 @whooshee.register_model('description')
 class Photo(db.Model):
+    # 游标分页按(timestamp, id)或(collect_count, id)排序
+    __table_args__ = (db.Index('ix_photo_timestamp_id', 'timestamp', 'id'),
+                      db.Index('ix_photo_author_id_timestamp_id', 'author_id', 'timestamp', 'id'),
+                      db.Index('ix_photo_collect_count_id', 'collect_count', 'id'))
+
     id = db.Column(db.Integer, primary_key=True)
-    filename = db.Column(db.String(64))
+    filename = db.Column(db.String(64), index=True)
     filename_m = db.Column(db.String(64))
     filename_s = db.Column(db.String(64))
     flag = db.Column(db.Integer, default=0)
     description = db.Column(db.String(500))
     can_comment = db.Column(db.Boolean, default=True)
+    processing = db.Column(db.Boolean, default=False)
+    # 上传时从文件头读取, 模板和按尺寸发送图片时不需要再打开文件
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    filesize = db.Column(db.Integer)
+    filesize_m = db.Column(db.Integer)
+    filesize_s = db.Column(db.Integer)
+    format = db.Column(db.String(10))
+    orientation = db.Column(db.Integer)
+    camera = db.Column(db.String(64))
+    taken_at = db.Column(db.DateTime)
+    # 图片加载之前显示的占位
+    blurhash = db.Column(db.String(32))
+    color = db.Column(db.String(7))
+    # 感知哈希和它的4段, 用来查找相似的图片
+    phash = db.Column(db.String(16))
+    phash_0 = db.Column(db.Integer, index=True)
+    phash_1 = db.Column(db.Integer, index=True)
+    phash_2 = db.Column(db.Integer, index=True)
+    phash_3 = db.Column(db.Integer, index=True)
+    # 由Collect和Comment的事件维护
+    collect_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    comment_count = db.Column(db.Integer, default=0)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     author = db.relationship('User', back_populates='photos')
     tags = db.relationship('Tag', back_populates='photos', secondary='tagging')
-    comments = db.relationship('Comment', back_populates='photo', cascade='all')
+    comments = db.relationship('Comment', back_populates='photo', cascade='all', order_by='Comment.id')
     collectors = db.relationship('Collect', back_populates='collected', cascade='all')
 
+    @db.validates('phash')
+    def validate_phash(self, key, phash):
+        self.phash_0, self.phash_1, self.phash_2, self.phash_3 = split_hash(phash) if phash else [None] * 4
+        return phash
+
+    @staticmethod
+    def find_similar(phash, distance=None, exclude=None):
+        """返回感知哈希的汉明距离不超过distance的图片, 先用分段索引找出候选, distance必须小于分段数"""
+        if distance is None:
+            distance = current_app.config['ALBUMY_SIMILAR_DISTANCE']
+        # 距离达到分段数时每一段都可能不同, 分段索引会漏掉相似的图片
+        if not 0 <= distance < BANDS:
+            raise ValueError('相似图片的汉明距离必须在0到%d之间' % (BANDS - 1))
+        bands = split_hash(phash)
+        # 候选只加载id和哈希值, 只有距离符合的图片才加载完整的行
+        query = db.session.query(Photo.id, Photo.phash). \
+            filter(db.or_(Photo.phash_0 == bands[0], Photo.phash_1 == bands[1],
+                          Photo.phash_2 == bands[2], Photo.phash_3 == bands[3]))
+        if exclude is not None:
+            query = query.filter(Photo.id != exclude)
+        ids = [photo_id for photo_id, other in query if hamming(phash, other) <= distance]
+        if not ids:
+            return []
+        return Photo.query.filter(Photo.id.in_(ids)).order_by(Photo.timestamp.desc()).all()
+
+    def similar_photos(self):
+        if self.phash is None:
+            return []
+        return Photo.find_similar(self.phash, exclude=self.id)
+
+
+# 缓存的热门标签, 只保存侧边栏用到的字段, 不绑定session
+TagRank = namedtuple('TagRank', ['id', 'name', 'photo_count'])
+
 
 @whooshee.register_model('name')
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20), index=True)
+    # 由update_tag_photo_count维护
+    photo_count = db.Column(db.Integer, default=0, index=True)
     photos = db.relationship('Photo', back_populates='tags', secondary='tagging')
 
     def __repr__(self):
         return '<Tag %r>' % self.name
 
+    @staticmethod
+    def popular():
+        """返回图片最多的10个标签, 结果缓存ALBUMY_POPULAR_TAGS_TIMEOUT秒"""
+        def load():
+            return [TagRank(*row) for row in db.session.query(Tag.id, Tag.name, Tag.photo_count).
+                    filter(Tag.photo_count > 0).order_by(Tag.photo_count.desc()).limit(10)]
+        return memory_cache.get('popular_tags', load, current_app.config['ALBUMY_POPULAR_TAGS_TIMEOUT'])
+
 
 tagging = db.Table('tagging',
                    db.Column('photo_id', db.ForeignKey('photo.id')),
-                   db.Column('tag_id', db.ForeignKey('tag.id')))
+                   db.Column('tag_id', db.ForeignKey('tag.id')),
+                   db.Index('ix_tagging_tag_id_photo_id', 'tag_id', 'photo_id'))
 
 
 class Comment(db.Model):
+    """评论按讨论串保存: root_id是顶层评论的id, path是从顶层评论到自己的id, depth是回复的层数.
+
+    按(root_id倒序, path)排序就是先显示最新的讨论串, 讨论串中的回复跟在被回复的评论后面.
+    这三个字段在插入后由set_comment_thread填写.
+    """
+    # path中每一段的宽度和回复的最大层数, 更深的回复和被回复的评论放在同一层, path最长230个字符
+    PATH_WIDTH = 10
+    MAX_DEPTH = 20
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     flag = db.Column(db.Integer, default=0)
@@ -240,6 +463,32 @@ class Comment(db.Model):
     replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
     replied = db.relationship('Comment', back_populates='replies', remote_side=[id])
     replies = db.relationship('Comment', back_populates='replied', cascade='all')
+    root_id = db.Column(db.Integer)
+    depth = db.Column(db.Integer, default=0)
+    path = db.Column(db.String(255))
+
+    @staticmethod
+    def thread_page(photo, page, per_page):
+        """按讨论串的顺序返回图片的一页评论, 作者和被回复的作者在同一条查询中加载, 总数使用photo.comment_count"""
+        query = Comment.query.with_parent(photo).options(
+            db.joinedload(Comment.author).load_only('username', 'name', 'avatar_s'),
+            db.joinedload(Comment.replied).load_only('author_id').
+            joinedload(Comment.author).load_only('username', 'name'))
+        items = query.order_by(Comment.root_id.desc(), Comment.path). \
+            limit(per_page).offset((page - 1) * per_page).all()
+        if not items and page != 1:
+            abort(404)
+        return Pagination(query, page, per_page, photo.comment_count or 0, items)
+
+    def page(self, per_page):
+        """评论在thread_page中的页数"""
+        before = Comment.query.filter(Comment.photo_id == self.photo_id, db.or_(
+            Comment.root_id > self.root_id, db.and_(Comment.root_id == self.root_id, Comment.path < self.path))).count()
+        return before // per_page + 1
+
+
+# 图片的评论页按(root_id倒序, path)从索引中顺序读取
+db.Index('ix_comment_photo_id_root_id_path', Comment.photo_id, Comment.root_id.desc(), Comment.path)
 
 
 class Collect(db.Model):
@@ -258,60 +507,350 @@ class Follow(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+class Timeline(db.Model):
+    """用户首页的动态. 上传图片时写入所有粉丝的时间线, 首页只需要按(user_id, timestamp)的索引范围查询"""
+    __table_args__ = (db.Index('ix_timeline_user_id_timestamp_photo_id', 'user_id', 'timestamp', 'photo_id'),)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id'), primary_key=True)
+    # 和Photo.timestamp相同, 排序时不需要再读取photo表
+    timestamp = db.Column(db.DateTime)
+
+    @staticmethod
+    def feed(user, per_page, cursor=None):
+        """返回用户首页的游标分页, 标记为celebrity和等待补齐时间线的用户的图片在这里合并"""
+        celebrities = [row[0] for row in db.session.query(Follow.followed_id).
+                       join(User, User.id == Follow.followed_id).
+                       filter(Follow.follower_id == user.id,
+                              db.or_(User.celebrity == db.true(), User.timeline_backfill == db.true()))]
+        query = Photo.query.options(*photo_feed_options())
+        if not celebrities:
+            query = query.join(Timeline, Timeline.photo_id == Photo.id).filter(Timeline.user_id == user.id)
+            return KeysetPagination(query, (Timeline.timestamp, Timeline.photo_id), per_page, cursor,
+                                    keys=('timestamp', 'id'))
+        timeline = db.session.query(Timeline.photo_id).filter(Timeline.user_id == user.id)
+        query = query.filter(db.or_(Photo.id.in_(timeline), Photo.author_id.in_(celebrities)))
+        return KeysetPagination(query, (Photo.timestamp, Photo.id), per_page, cursor)
+
+
 class Notification(db.Model):
+    """消息只保存类型和相关的id, 显示时再生成内容. 旧的消息没有kind, 直接显示message中的HTML"""
+    FOLLOW = 1
+    COMMENT = 2
+    COLLECT = 3
+
+    __table_args__ = (db.Index('ix_notification_receiver_id_timestamp_id', 'receiver_id', 'timestamp', 'id'),
+                      # 合并未读消息时按(接收者, 类型, 图片)查找
+                      db.Index('ix_notification_receiver_id_kind_photo_id', 'receiver_id', 'kind', 'photo_id'))
+
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(db.Text)
-    is_read = db.Column(db.Boolean, default=False)
+    kind = db.Column(db.SmallInteger)
+    # 合并的消息记录最后一个操作的用户和评论, count是合并的次数
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id', ondelete='SET NULL'))
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id', ondelete='SET NULL'))
+    count = db.Column(db.Integer, default=1)
+    # 修改时加载原来的值, 未读计数需要知道是不是真的从未读变成了已读
+    is_read = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    receiver = db.relationship('User', back_populates='notifications')
+    receiver = db.relationship('User', back_populates='notifications', foreign_keys=[receiver_id])
+    actor = db.relationship('User', foreign_keys=[actor_id])
+    photo = db.relationship('Photo')
+
+
+# 列表页面的加载方式, 模板用到的字段和关系和列表一起查询, 每页的查询次数和每页显示的数量无关
+PHOTO_CARD_FIELDS = ('filename', 'filename_s', 'width', 'height', 'blurhash', 'color', 'processing',
+                     'collect_count', 'comment_count', 'timestamp')
+
+
+def photo_card_options():
+    """photo_card宏只用到缩略图和计数字段"""
+    return [db.load_only(*PHOTO_CARD_FIELDS)]
+
+
+def photo_feed_options():
+    """首页的动态还要显示中图, 描述和作者"""
+    return [db.load_only(*PHOTO_CARD_FIELDS, 'filename_m', 'description', 'author_id'),
+            db.joinedload(Photo.author).load_only('username', 'name', 'avatar_m')]
+
+
+def invalidate_on_commit(session, key):
+    """session提交之后删除memory_cache中的key, 回滚时不删除"""
+    session.info.setdefault('invalidate', set()).add(key)
+
+
+def change_counter(connection, model, row_id, column, delta):
+    """用UPDATE ... SET x = x + delta修改计数, 并发的修改不会互相覆盖"""
+    table = model.__table__
+    connection.execute(table.update().where(table.c.id == row_id).values({column: table.c[column] + delta}))
+
+
+@db.event.listens_for(Collect, 'after_insert')
+def increase_collect_count(mapper, connection, target):
+    change_counter(connection, Photo, target.collected_id, 'collect_count', 1)
+    change_counter(connection, User, target.collector_id, 'collection_count', 1)
+
+
+@db.event.listens_for(Collect, 'after_delete')
+def decrease_collect_count(mapper, connection, target):
+    change_counter(connection, Photo, target.collected_id, 'collect_count', -1)
+    change_counter(connection, User, target.collector_id, 'collection_count', -1)
+
+
+@db.event.listens_for(Photo, 'after_insert')
+def increase_photo_count(mapper, connection, target):
+    change_counter(connection, User, target.author_id, 'photo_count', 1)
+
+
+@db.event.listens_for(Photo, 'after_delete')
+def decrease_photo_count(mapper, connection, target):
+    change_counter(connection, User, target.author_id, 'photo_count', -1)
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def increase_comment_count(mapper, connection, target):
+    change_counter(connection, Photo, target.photo_id, 'comment_count', 1)
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def set_comment_thread(mapper, connection, target):
+    # path中包含自己的id, 只能在插入之后填写
+    table = Comment.__table__
+    segment = '%0*d' % (Comment.PATH_WIDTH, target.id)
+    root_id, depth, path = target.id, 0, segment
+    if target.replied_id is not None:
+        parent = connection.execute(db.select([table.c.root_id, table.c.depth, table.c.path]).
+                                    where(table.c.id == target.replied_id)).first()
+        if parent is not None:
+            root_id = parent.root_id
+            if parent.depth < Comment.MAX_DEPTH:
+                depth, path = parent.depth + 1, parent.path + '/' + segment
+            else:
+                depth, path = parent.depth, parent.path.rpartition('/')[0] + '/' + segment
+    connection.execute(table.update().where(table.c.id == target.id).values(root_id=root_id, depth=depth, path=path))
+    for name, value in (('root_id', root_id), ('depth', depth), ('path', path)):
+        set_committed_value(target, name, value)
+
+
+@db.event.listens_for(Comment, 'after_update')
+def move_comment_thread(mapper, connection, target):
+    # 插入之后才设置被回复的评论时重新计算, 只处理还没有回复的新评论
+    attrs = db.inspect(target).attrs
+    if attrs.replied_id.history.has_changes() or attrs.replied.history.has_changes():
+        set_comment_thread(mapper, connection, target)
+
+
+@db.event.listens_for(Comment, 'after_delete')
+def decrease_comment_count(mapper, connection, target):
+    change_counter(connection, Photo, target.photo_id, 'comment_count', -1)
+
+
+@db.event.listens_for(Follow, 'after_insert')
+def increase_follow_count(mapper, connection, target):
+    if target.follower_id != target.followed_id:
+        change_counter(connection, User, target.followed_id, 'follower_count', 1)
+        change_counter(connection, User, target.follower_id, 'following_count', 1)
+        update_celebrity(connection, target.followed_id)
+
+
+@db.event.listens_for(Follow, 'after_delete')
+def decrease_follow_count(mapper, connection, target):
+    if target.follower_id != target.followed_id:
+        change_counter(connection, User, target.followed_id, 'follower_count', -1)
+        change_counter(connection, User, target.follower_id, 'following_count', -1)
+        update_celebrity(connection, target.followed_id)
+
+
+def change_unread_count(connection, notification, delta):
+    change_counter(connection, User, notification.receiver_id, 'unread_notification_count', delta)
+
+
+@db.event.listens_for(Notification, 'after_insert')
+def increase_unread_count(mapper, connection, target):
+    if not target.is_read:
+        change_unread_count(connection, target, 1)
+
+
+@db.event.listens_for(Notification, 'after_update')
+def update_unread_count(mapper, connection, target):
+    added, _, deleted = db.inspect(target).attrs.is_read.history
+    if added and deleted and bool(added[0]) != bool(deleted[0]):
+        change_unread_count(connection, target, -1 if added[0] else 1)
+
+
+@db.event.listens_for(Notification, 'after_delete')
+def decrease_unread_count(mapper, connection, target):
+    if not target.is_read:
+        change_unread_count(connection, target, -1)
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def update_tag_photo_count(session, flush_context, instances):
+    # tagging是关联表, 没有自己的事件, 在flush之前从Photo.tags的修改记录中计算每个标签的变化
+    deltas = {}
+    for photo in session.new.union(session.dirty):
+        if isinstance(photo, Photo):
+            added, _, deleted = db.inspect(photo).attrs.tags.history
+            for tag in added or ():
+                deltas[tag] = deltas.get(tag, 0) + 1
+            for tag in deleted or ():
+                deltas[tag] = deltas.get(tag, 0) - 1
+    for photo in session.deleted:
+        if isinstance(photo, Photo):
+            for tag in photo.tags:
+                deltas[tag] = deltas.get(tag, 0) - 1
+    if deltas or any(isinstance(obj, Tag) for obj in session.deleted):
+        invalidate_on_commit(session, 'popular_tags')
+    for tag, delta in deltas.items():
+        if not delta or tag in session.deleted:
+            continue
+        if tag.id is None:
+            tag.photo_count = (tag.photo_count or 0) + delta
+        else:
+            change_counter(session.connection(), Tag, tag.id, 'photo_count', delta)
+            session.expire(tag, ['photo_count'])
+
+
+def fan_out(connection, author_id):
+    """作者没有标记为celebrity时返回True"""
+    if author_id is None:
+        return False
+    user = User.__table__
+    return not connection.scalar(db.select([user.c.celebrity]).where(user.c.id == author_id))
+
+
+def update_celebrity(connection, user_id):
+    """粉丝数超过ALBUMY_TIMELINE_FANOUT_LIMIT时标记为celebrity, 降到一半以下才取消, 避免在边界上来回切换.
+
+    标记期间的图片没有写入粉丝的时间线, 这期间关注的粉丝也没有补齐时间线. 粉丝可能非常多, 取消标记时
+    不在请求中补齐, 只标记timeline_backfill, 由backfill-timeline命令分批补齐, 补齐之前首页仍然合并读取.
+    """
+    limit = current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT']
+    user = User.__table__
+    row = connection.execute(db.select([user.c.follower_count, user.c.celebrity]).where(user.c.id == user_id)).first()
+    if row is None:
+        return
+    followers = row.follower_count or 0
+    if not row.celebrity and followers > limit:
+        connection.execute(user.update().where(user.c.id == user_id).values(celebrity=True, timeline_backfill=False))
+    elif row.celebrity and followers < limit // 2:
+        connection.execute(user.update().where(user.c.id == user_id).values(celebrity=False, timeline_backfill=True))
+
+
+@db.event.listens_for(Photo, 'after_insert')
+def push_to_timelines(mapper, connection, target):
+    # 用一条INSERT ... SELECT写入所有粉丝(包括作者自己)的时间线
+    if not fan_out(connection, target.author_id):
+        return
+    follow = Follow.__table__
+    select = db.select([follow.c.follower_id, db.literal(target.id), db.literal(target.timestamp, db.DateTime)]). \
+        where(follow.c.followed_id == target.author_id)
+    connection.execute(Timeline.__table__.insert().from_select(['user_id', 'photo_id', 'timestamp'], select))
+
+
+@db.event.listens_for(Photo, 'after_delete')
+def remove_from_timelines(mapper, connection, target):
+    timeline = Timeline.__table__
+    connection.execute(timeline.delete().where(timeline.c.photo_id == target.id))
+
+
+@db.event.listens_for(Follow, 'after_insert')
+def backfill_timeline(mapper, connection, target):
+    if not fan_out(connection, target.followed_id):
+        return
+    photo = Photo.__table__
+    select = db.select([db.literal(target.follower_id), photo.c.id, photo.c.timestamp]). \
+        where(photo.c.author_id == target.followed_id)
+    connection.execute(Timeline.__table__.insert().from_select(['user_id', 'photo_id', 'timestamp'], select))
+
+
+@db.event.listens_for(Follow, 'after_delete')
+def prune_timeline(mapper, connection, target):
+    timeline, photo = Timeline.__table__, Photo.__table__
+    connection.execute(timeline.delete().where(db.and_(
+        timeline.c.user_id == target.follower_id,
+        timeline.c.photo_id.in_(db.select([photo.c.id]).where(photo.c.author_id == target.followed_id)))))
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def track_role_changes(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, (Role, Permission)):
+            continue
+        # 修改用户的角色时Role.users也会变化, 只有名称和权限的变化需要重新编译
+        attrs = db.inspect(obj).attrs
+        if obj not in session.dirty or attrs.name.history.has_changes() or \
+                isinstance(obj, Role) and attrs.permissions.history.has_changes():
+            invalidate_on_commit(session, 'roles')
+            return
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def track_user_changes(session, flush_context):
+    # 新用户也要失效, 避免重建数据库后读到相同id的旧快照. 修改role时role_id在flush中才同步, 所以也检查role
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, User):
+            continue
+        attrs = db.inspect(obj).attrs
+        if obj not in session.dirty or any(attrs[name].history.has_changes()
+                                           for name in USER_SNAPSHOT_FIELDS + ('role',)):
+            invalidate_on_commit(session, 'user:%d' % obj.id)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def invalidate_caches(session):
+    # 提交之后再失效, 避免其它请求在提交之前又缓存了旧的结果
+    for key in session.info.pop('invalidate', ()):
+        memory_cache.delete(key)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_cache_changes(session):
+    session.info.pop('invalidate', None)
 
 
 @db.event.listens_for(Photo, 'after_delete')
 def delete_photos(mapper, connection, target):
-    for filename in [target.filename, target.filename_s, target.filename_m]:
+    # 去重保存时多个Photo共用同一组文件, 最后一个引用被删除时才删除文件
+    photo = Photo.__table__
+    references = connection.scalar(
+        db.select([db.func.count()]).select_from(photo).where(photo.c.filename == target.filename))
+    if references:
+        return
+    for filename in {target.filename, target.filename_s, target.filename_m}:
         if filename is not None:
-            path = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
-            if os.path.exists(path):
-                os.remove(path)
+            remove_image(current_app.config['ALBUMY_UPLOAD_PATH'], filename,
+                         current_app.config['ALBUMY_IMAGE_VARIANTS'])
 
 
 @db.event.listens_for(User.avatar_raw, 'set')
 def change_avatar(target, value, oldvalue, initiator):
     if oldvalue and symbol('NO_VALUE') != oldvalue:
-        path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
-        if os.path.exists(path):
-            os.remove(path)
+        remove_file(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
 
 
 @db.event.listens_for(User.avatar_s, 'set')
 def change_avatar(target, value, oldvalue, initiator):
     if symbol('NO_VALUE') != oldvalue:
-        path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
-        if os.path.exists(path):
-            os.remove(path)
+        remove_file(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
 
 
 @db.event.listens_for(User.avatar_m, 'set')
 def change_avatar(target, value, oldvalue, initiator):
     if symbol('NO_VALUE') != oldvalue:
-        path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
-        if os.path.exists(path):
-            os.remove(path)
+        remove_file(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
 
 
 @db.event.listens_for(User.avatar_l, 'set')
 def change_avatar(target, value, oldvalue, initiator):
     if symbol('NO_VALUE') != oldvalue:
-        path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
-        if os.path.exists(path):
-            os.remove(path)
+        remove_file(current_app.config['AVATARS_SAVE_PATH'], oldvalue)
 
 
 @db.event.listens_for(User, 'after_delete')
 def delete_user(mapper, connection, target):
     for filename in [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw]:
         if filename is not None:
-            path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename)
-            if os.path.exists(path):
-                os.remove(path)
+            remove_file(current_app.config['AVATARS_SAVE_PATH'], filename)
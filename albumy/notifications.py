@@ -1,27 +1,62 @@
-from flask import url_for
+from datetime import datetime
 
 from .extensions import db
-from .models import Notification
+from .models import User, Notification, change_counter
+
+
+def push_notification(kind, receiver, actor, photo_id=None, comment=None):
+    """登记一条消息, 在下一次提交时和其它修改在同一个事务中写入. 调用之后还需要提交session.
+
+    同一次提交中相同的消息先在内存中合并, 写入时再和数据库中的未读消息合并, 见write_notifications.
+    """
+    pending = db.session.info.setdefault('notifications', {})
+    key = (receiver.id, kind, photo_id)
+    count = pending[key][0] + 1 if key in pending else 1
+    pending[key] = (count, actor.id, comment)
+
+
+@db.event.listens_for(db.session, 'before_commit')
+def write_notifications(session):
+    """同一张图片(关注时是同一个接收者)的同类未读消息合并成一条, 只增加次数并记录最后一个操作的用户"""
+    pending = session.info.pop('notifications', None)
+    if not pending:
+        return
+    # 评论可能还没有写入, 先flush得到id
+    session.flush()
+    for (receiver_id, kind, photo_id), (count, actor_id, comment) in pending.items():
+        comment_id = comment.id if comment is not None else None
+        merged = session.query(Notification). \
+            filter_by(receiver_id=receiver_id, kind=kind, photo_id=photo_id, is_read=False). \
+            update({Notification.count: Notification.count + count, Notification.actor_id: actor_id,
+                    Notification.comment_id: comment_id, Notification.timestamp: datetime.utcnow()},
+                   synchronize_session=False)
+        if not merged:
+            session.add(Notification(kind=kind, receiver_id=receiver_id, actor_id=actor_id, photo_id=photo_id,
+                                     comment_id=comment_id, count=count))
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_notifications(session):
+    session.info.pop('notifications', None)
 
 
 def push_follow_notification(follower, receiver):
-    message = '用户<a href="%s">%s</a>关注了你.' % (url_for('user.index', username=follower.username), follower.username)
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+    push_notification(Notification.FOLLOW, receiver, follower)
 
 
-def push_commit_notification(photo_id, receiver, page=1):
-    message = '<a href="%s#comments">这张图片</a>有一条新评论/回复' % (url_for('main.show_photo', photo_id=photo_id, page=page))
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+def push_commit_notification(comment, receiver):
+    # 评论还没有写入, photo_id和id都还是空的
+    push_notification(Notification.COMMENT, receiver, comment.author, comment.photo.id, comment)
 
 
 def push_collect_notification(collector, photo_id, receiver):
-    message = '用户<a href="%s">%s</a>收藏了你的<a href="%s">图片</a>' % (
-        url_for('user.index', username=collector.username), collector.username,
-        url_for('main.show_photo', photo_id=photo_id))
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
+    push_notification(Notification.COLLECT, receiver, collector, photo_id)
+
+
+def read_all_notifications(user):
+    """用一条UPDATE把用户的未读消息全部标记为已读, 不把消息加载到ORM中"""
+    count = Notification.query.filter_by(receiver_id=user.id, is_read=False). \
+        update({Notification.is_read: True}, synchronize_session=False)
+    # 批量修改不会触发Notification的事件, 按实际修改的行数减少计数
+    change_counter(db.session, User, user.id, 'unread_notification_count', -count)
     db.session.commit()
@@ -0,0 +1,105 @@
+"""游标分页
+
+OFFSET分页越往后需要跳过的行越多, 每次还要额外查询一次总数. 游标分页记录当前页第一条和最后一条记录的
+排序字段, 下一页直接从索引中的这个位置开始读取, 任意一页的速度都一样. 游标对客户端是不透明的字符串.
+"""
+import base64
+import json
+from datetime import datetime
+
+from flask import abort
+
+from .extensions import db
+
+
+def dump_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def load_cursor(cursor):
+    """游标无效时返回400"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except ValueError:
+        abort(400)
+
+
+def encode_cursor(direction, values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return dump_cursor([direction] + values)
+
+
+def decode_cursor(cursor, columns):
+    """返回游标的方向和排序字段的值, 游标无效时返回400"""
+    data = load_cursor(cursor)
+    try:
+        direction, values = data[0], data[1:]
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            raise ValueError
+        return direction, [datetime.fromisoformat(value) if column.type.python_type is datetime
+                           else column.type.python_type(value) for column, value in zip(columns, values)]
+    except (ValueError, TypeError, LookupError):
+        abort(400)
+
+
+def _after(columns, values):
+    """按columns倒序排列时排在values后面的记录, (a, b) < (x, y)展开成a <= x and (a < x or (a = x and b < y)).
+
+    最外层的a <= x让数据库可以直接在索引中定位, 只有or的条件时会扫描整个索引.
+    """
+    if len(columns) == 1:
+        return columns[0] < values[0]
+    return db.and_(columns[0] <= values[0], db.or_(
+        columns[0] < values[0], db.and_(columns[0] == values[0], _after(columns[1:], values[1:]))))
+
+
+def _before(columns, values):
+    if len(columns) == 1:
+        return columns[0] > values[0]
+    return db.and_(columns[0] >= values[0], db.or_(
+        columns[0] > values[0], db.and_(columns[0] == values[0], _before(columns[1:], values[1:]))))
+
+
+class KeysetPagination:
+    """按columns倒序的游标分页, 最后一个字段必须唯一, 一般是(timestamp, id).
+
+    items, has_next和has_prev的含义和Flask-SQLAlchemy的Pagination相同, next_cursor和prev_cursor
+    是上一页和下一页的游标, 没有时为None. 排序字段不在items上时用keys指定items上对应的属性名.
+    """
+
+    def __init__(self, query, columns, per_page, cursor=None, keys=None):
+        self.columns = columns
+        self.keys = keys or [column.key for column in columns]
+        self.per_page = per_page
+        direction = 'next'
+        if cursor:
+            direction, values = decode_cursor(cursor, columns)
+            query = query.filter(_after(columns, values) if direction == 'next' else _before(columns, values))
+
+        # 多取一条, 用来判断后面还有没有记录
+        if direction == 'next':
+            items = query.order_by(*[column.desc() for column in columns]).limit(per_page + 1).all()
+        else:
+            items = query.order_by(*[column.asc() for column in columns]).limit(per_page + 1).all()
+        more = len(items) > per_page
+        self.items = items[:per_page]
+        if direction == 'next':
+            self.has_prev, self.has_next = bool(cursor), more
+        else:
+            self.items.reverse()
+            self.has_prev, self.has_next = more, True
+
+    def _cursor(self, direction, item):
+        return encode_cursor(direction, [getattr(item, key) for key in self.keys])
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.items:
+            return self._cursor('next', self.items[-1])
+        return None
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.items:
+            return self._cursor('prev', self.items[0])
+        return None
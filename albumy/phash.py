@@ -0,0 +1,57 @@
+"""图片的感知哈希(dHash), 用来查找重复上传的相似图片
+
+64位的哈希值分成4段, 每段16位分别建立索引. 两个哈希值的汉明距离不超过3时至少有一段完全相同,
+所以只需要查询有任意一段相同的图片, 再在Python中计算汉明距离.
+"""
+from PIL import Image
+
+HASH_SIZE = 8
+BANDS = 4
+BAND_BITS = HASH_SIZE * HASH_SIZE // BANDS
+
+
+def dhash_pixels(img):
+    """把图片缩小成9x8的灰度图, 返回72个字节的像素值"""
+    # JPEG可以直接按1/8的比例解码
+    img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    return img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).tobytes()
+
+
+def dhash(img):
+    """返回图片的dHash, 格式为16个字符的十六进制字符串. 每一位表示一个像素是否比它左边的像素亮"""
+    return pixels_hash(dhash_pixels(img))
+
+
+def pixels_hash(pixels):
+    """用dhash_pixels返回的像素计算dHash"""
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = value << 1 | (pixels[offset + col + 1] > pixels[offset + col])
+    return '%016x' % value
+
+
+def dhash_many(pixels):
+    """一次计算多张图片的dHash, pixels是dhash_pixels返回值的列表, 结果和dhash相同.
+    安装了NumPy时整批一起计算, 没有NumPy时逐张计算
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return [pixels_hash(item) for item in pixels]
+
+    grid = np.frombuffer(b''.join(pixels), dtype=np.uint8).reshape(-1, HASH_SIZE, HASH_SIZE + 1)
+    bits = grid[:, :, 1:] > grid[:, :, :-1]
+    return [row.tobytes().hex() for row in np.packbits(bits.reshape(len(pixels), -1), axis=1)]
+
+
+def split_hash(phash):
+    """把十六进制的哈希值分成BANDS段, 返回每段的整数值"""
+    value = int(phash, 16)
+    mask = (1 << BAND_BITS) - 1
+    return [value >> (BAND_BITS * (BANDS - i - 1)) & mask for i in range(BANDS)]
+
+
+def hamming(phash, other):
+    return bin(int(phash, 16) ^ int(other, 16)).count('1')
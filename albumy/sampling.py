@@ -0,0 +1,65 @@
+"""不扫描整张表的随机抽样
+
+ORDER BY random()每次都要读取并排序整张表. 这里用种子生成主键的一个伪随机排列id = (a * i + b) mod p,
+p是大于最大主键的质数, 按顺序探测排列中的主键, 每次只按主键查询一小批. 游标记录种子和探测到的位置,
+加载更多时从上次的位置继续, 同一个游标序列中不会出现重复的记录.
+"""
+import random
+
+from flask import abort
+
+from .extensions import db
+from .pagination import dump_cursor, load_cursor
+
+# 被删除的记录留下的空洞太多时最多探测的轮数
+MAX_ROUNDS = 10
+
+
+def is_prime(n):
+    return n >= 2 and all(n % i for i in range(2, int(n ** 0.5) + 1))
+
+
+def next_prime(n):
+    """返回不小于n的最小质数"""
+    n = max(n, 2)
+    while not is_prime(n):
+        n += 1
+    return n
+
+
+def random_sample(query, column, count, cursor=None):
+    """从query中随机取出最多count条记录, column是整数主键. 返回记录和下一批的游标, 没有更多记录时游标为None"""
+    if cursor:
+        data = load_cursor(cursor)
+        # bool是int的子类, 要排除
+        if not isinstance(data, list) or len(data) != 3 or not all(type(value) is int for value in data):
+            abort(400)
+        seed, position, prime = data
+        # 游标中的质数不能超过按当前最大主键生成的质数, 否则伪造的游标可以让探测的范围任意大
+        max_id = db.session.query(db.func.max(column)).scalar() or 0
+        if not 0 <= position <= prime or prime > next_prime(max_id + 1) or not is_prime(prime):
+            abort(400)
+    else:
+        max_id = db.session.query(db.func.max(column)).scalar()
+        if max_id is None:
+            return [], None
+        seed, position, prime = random.getrandbits(32), 0, next_prime(max_id + 1)
+
+    rng = random.Random(seed)
+    a, b = rng.randrange(1, prime), rng.randrange(prime)
+    items = []
+    for _ in range(MAX_ROUNDS):
+        if len(items) >= count or position >= prime:
+            break
+        # 多探测一些, 跳过被删除的主键
+        end = min(position + (count - len(items)) * 2, prime)
+        ids = [(a * i + b) % prime for i in range(position, end)]
+        found = {getattr(item, column.key): item for item in query.filter(column.in_(ids))}
+        for i, row_id in enumerate(ids, position):
+            if row_id in found:
+                items.append(found[row_id])
+                if len(items) == count:
+                    end = i + 1
+                    break
+        position = end
+    return items, dump_cursor([seed, position, prime]) if position < prime else None
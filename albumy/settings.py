@@ -26,6 +26,34 @@ class BaseConfig:
         ALBUMY_PHOTO_SIZE['small']: '_s',
         ALBUMY_PHOTO_SIZE['medium']: '_m',
     }
+    # 为中图和小图额外生成的格式, 按优先顺序排列, 当前的Pillow不支持的格式会被忽略
+    ALBUMY_IMAGE_VARIANTS = ['avif', 'webp']
+    # 感知哈希的汉明距离不超过这个值时认为是相似的图片, 必须小于phash.BANDS, 否则分段索引会漏掉相似的图片
+    ALBUMY_SIMILAR_DISTANCE = 3
+    # 上传的图片和已有的图片相似时提示用户
+    ALBUMY_WARN_SIMILAR_UPLOADS = True
+    # 粉丝数超过这个值的用户上传图片时不写入粉丝的时间线, 粉丝打开首页时再查询
+    ALBUMY_TIMELINE_FANOUT_LIMIT = 5000
+    # 首页热门标签的缓存时间(秒), 标签变化时立即失效
+    ALBUMY_POPULAR_TAGS_TIMEOUT = 300
+    # 角色权限的缓存时间(秒), 本进程修改角色时立即失效, 其它进程最多在这个时间之后生效
+    ALBUMY_ROLE_CACHE_TIMEOUT = 600
+    # 登录用户快照的缓存时间(秒), 本进程修改用户时立即失效
+    ALBUMY_USER_CACHE_TIMEOUT = 60
+    # 生成缩略图的进程数, 0表示在请求中直接生成
+    ALBUMY_THUMBNAIL_WORKERS = 2
+    # 按内容的SHA-256摘要保存上传的图片, 相同的图片只保存一份
+    ALBUMY_DEDUPLICATE_UPLOADS = False
+    # 图片的文件名对应的内容不会改变, 允许浏览器缓存一年
+    ALBUMY_IMAGE_CACHE_TIMEOUT = 365 * 24 * 60 * 60
+    # nginx中对应ALBUMY_UPLOAD_PATH的internal location, 例如'/protected-uploads',
+    # 设置后图片由nginx发送, 否则由WSGI服务器的wsgi.file_wrapper发送
+    ALBUMY_ACCEL_REDIRECT = None
+    # /uploads/<filename>/w/<width>允许按需生成的宽度
+    ALBUMY_PHOTO_WIDTHS = [200, 400, 600, 800, 1200]
+    # 按需生成的图片的缓存目录和容量上限, 超过上限时删除最久没有访问的文件
+    ALBUMY_RENDITION_PATH = os.path.join(ALBUMY_UPLOAD_PATH, 'renditions')
+    ALBUMY_RENDITION_CACHE_SIZE = 512 * 1024 * 1024
 
     SECRET_KEY = 'secret key'
     MAX_CONTENT_LENGTH = 5 * 1024 * 1024
@@ -65,7 +93,14 @@ class Development(BaseConfig):
 class Testing(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    ALBUMY_THUMBNAIL_WORKERS = 0
+    # 每个测试使用新的数据库, 不能使用之前缓存的结果
+    ALBUMY_POPULAR_TAGS_TIMEOUT = 0
+    ALBUMY_ROLE_CACHE_TIMEOUT = 0
+    ALBUMY_USER_CACHE_TIMEOUT = 0
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    # 搜索索引保存在内存中, 测试不写入仓库中的whooshee目录
+    WHOOSHEE_MEMORY_STORAGE = True
 
 
 class Production(BaseConfig):
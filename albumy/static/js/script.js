@@ -182,6 +182,107 @@ $(function () {
 
     }
 
+    function update_processing_images() {
+        $('img[data-status]').each(function () {
+            var $el = $(this);
+            $.ajax({
+                type: 'GET',
+                url: $el.data('status'),
+                success: function (data) {
+                    if (!data.processing) {
+                        $el.attr('src', data[$el.data('size')]);
+                        $el.removeAttr('data-status');
+                    }
+                }
+            })
+        });
+        if ($('img[data-status]').length) {
+            setTimeout(update_processing_images, 2000);
+        }
+    }
+
+    var BLURHASH_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+
+    function decode83(str) {
+        var value = 0;
+        for (var i = 0; i < str.length; i++) {
+            value = value * 83 + BLURHASH_DIGITS.indexOf(str[i]);
+        }
+        return value;
+    }
+
+    function srgb_to_linear(value) {
+        value = value / 255;
+        return value <= 0.04045 ? value / 12.92 : Math.pow((value + 0.055) / 1.055, 2.4);
+    }
+
+    function linear_to_srgb(value) {
+        value = Math.max(0, Math.min(1, value));
+        return value <= 0.0031308 ? value * 12.92 * 255 + 0.5 : (1.055 * Math.pow(value, 1 / 2.4) - 0.055) * 255 + 0.5;
+    }
+
+    function sign_pow(value, exp) {
+        return (value < 0 ? -1 : 1) * Math.pow(Math.abs(value), exp);
+    }
+
+    function decode_blurhash(hash, width, height) {
+        var size_flag = decode83(hash[0]);
+        var num_x = size_flag % 9 + 1;
+        var num_y = Math.floor(size_flag / 9) + 1;
+        var max_value = (decode83(hash[1]) + 1) / 166;
+        var colors = [];
+        for (var i = 0; i < num_x * num_y; i++) {
+            if (i === 0) {
+                var dc = decode83(hash.substring(2, 6));
+                colors.push([srgb_to_linear(dc >> 16), srgb_to_linear((dc >> 8) & 255), srgb_to_linear(dc & 255)]);
+            } else {
+                var ac = decode83(hash.substring(4 + i * 2, 6 + i * 2));
+                colors.push([
+                    sign_pow((Math.floor(ac / 361) - 9) / 9, 2) * max_value,
+                    sign_pow((Math.floor(ac / 19) % 19 - 9) / 9, 2) * max_value,
+                    sign_pow((ac % 19 - 9) / 9, 2) * max_value
+                ]);
+            }
+        }
+        var pixels = new Uint8ClampedArray(width * height * 4);
+        for (var y = 0; y < height; y++) {
+            for (var x = 0; x < width; x++) {
+                var r = 0, g = 0, b = 0;
+                for (var j = 0; j < num_y; j++) {
+                    for (i = 0; i < num_x; i++) {
+                        var basis = Math.cos(Math.PI * x * i / width) * Math.cos(Math.PI * y * j / height);
+                        var color = colors[i + j * num_x];
+                        r += color[0] * basis;
+                        g += color[1] * basis;
+                        b += color[2] * basis;
+                    }
+                }
+                var index = 4 * (x + y * width);
+                pixels[index] = linear_to_srgb(r);
+                pixels[index + 1] = linear_to_srgb(g);
+                pixels[index + 2] = linear_to_srgb(b);
+                pixels[index + 3] = 255;
+            }
+        }
+        return pixels;
+    }
+
+    function render_blurhash_placeholders() {
+        var canvas = document.createElement('canvas');
+        canvas.width = canvas.height = 32;
+        var context = canvas.getContext('2d');
+        $('img[data-blurhash]').each(function () {
+            // 已经从缓存中加载完成的图片不需要占位
+            if (this.complete && this.naturalWidth) {
+                return;
+            }
+            var image_data = context.createImageData(32, 32);
+            image_data.data.set(decode_blurhash($(this).attr('data-blurhash'), 32, 32));
+            context.putImageData(image_data, 0, 0);
+            $(this).css({'background-image': 'url(' + canvas.toDataURL() + ')', 'background-size': 'cover'});
+        });
+    }
+
     $(document).ajaxError(function (event, request, settings) {
         var message = null;
         if (request.responseJSON && request.responseJSON.hasOwnProperty('message')) {
@@ -230,6 +331,10 @@ $(function () {
     $(document).on('click', '.unfollow-btn', unfollow.bind(this));
     $(document).on('click', '.collect-btn', collect.bind(this));
     $(document).on('click', '.uncollect-btn', uncollect.bind(this));
+    if ($('img[data-status]').length) {
+        setTimeout(update_processing_images, 2000);
+    }
+    render_blurhash_placeholders();
     if (is_authenticated) {
         setInterval(update_notifications_count, 30000);
     }
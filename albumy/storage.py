@@ -0,0 +1,50 @@
+import hashlib
+import os
+
+
+def shard_path(filename):
+    """按文件名的MD5分两级目录保存, 返回相对路径, 例如: 3f/a2/filename"""
+    digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], filename)
+
+
+def locate_file(base_path, filename):
+    """返回文件相对于base_path的路径, 还没有迁移到分级目录的文件仍然直接放在base_path下"""
+    path = shard_path(filename)
+    if not os.path.exists(os.path.join(base_path, path)) and os.path.exists(os.path.join(base_path, filename)):
+        return filename
+    return path
+
+
+def variant_name(filename, fmt):
+    """同一张图片的其它格式的文件名, 例如: abc_m.jpg.webp"""
+    return '%s.%s' % (filename, fmt)
+
+
+def storage_path(base_path, filename):
+    """返回新文件应该保存的绝对路径, 并创建所在的目录"""
+    path = os.path.join(base_path, shard_path(filename))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def remove_file(base_path, filename):
+    path = os.path.join(base_path, locate_file(base_path, filename))
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def remove_image(base_path, filename, variants):
+    """删除图片和它的其它格式"""
+    remove_file(base_path, filename)
+    for fmt in variants:
+        remove_file(base_path, variant_name(filename, fmt))
+
+
+def move_to_shard(base_path, filename):
+    """把直接放在base_path下的文件移动到分级目录中, 返回是否移动了文件"""
+    src = os.path.join(base_path, filename)
+    if not os.path.isfile(src):
+        return False
+    os.replace(src, storage_path(base_path, filename))
+    return True
@@ -0,0 +1,68 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from flask import current_app
+
+from .extensions import db
+from .models import Photo
+from .storage import remove_image
+from .utils import generate_thumbnails, image_variants
+
+_executor = None
+
+
+def _get_executor(max_workers):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=max_workers)
+    return _executor
+
+
+def submit_thumbnails(photo):
+    """生成中图和小图, ALBUMY_THUMBNAIL_WORKERS不为0时放到进程池里执行, 不占用请求的处理时间"""
+    app = current_app._get_current_object()
+    args = (photo.filename, app.config['ALBUMY_UPLOAD_PATH'], app.config['ALBUMY_PHOTO_SIZE'],
+            app.config['ALBUMY_PHOTO_SUFFIX'], image_variants())
+    max_workers = app.config['ALBUMY_THUMBNAIL_WORKERS']
+    if not max_workers:
+        try:
+            result = generate_thumbnails(*args)
+        except IOError:
+            app.logger.exception('生成缩略图失败: %s' % photo.filename)
+            result = None
+        _save_thumbnails(photo.filename, result)
+        return
+    future = _get_executor(max_workers).submit(generate_thumbnails, *args)
+    future.add_done_callback(partial(_thumbnails_done, app, photo.filename))
+
+
+def _thumbnails_done(app, filename, future):
+    with app.app_context():
+        if future.exception() is not None:
+            app.logger.error('生成缩略图失败: %s' % filename, exc_info=future.exception())
+            result = None
+        else:
+            result = future.result()
+        _save_thumbnails(filename, result)
+
+
+def _save_thumbnails(filename, result):
+    # 同一个原图可能被多个Photo引用, 生成失败时继续使用原图
+    photos = Photo.query.filter_by(filename=filename).all()
+    if not photos:
+        # 图片在生成缩略图的过程中被删除了
+        if result is not None:
+            for name in {result['name_m'], result['name_s']}:
+                remove_image(current_app.config['ALBUMY_UPLOAD_PATH'], name,
+                             current_app.config['ALBUMY_IMAGE_VARIANTS'])
+        return
+    for photo in photos:
+        if result is not None:
+            photo.filename_m = result['name_m']
+            photo.filename_s = result['name_s']
+            photo.filesize_m = result['size_m']
+            photo.filesize_s = result['size_s']
+            photo.blurhash = result['blurhash']
+            photo.color = result['color']
+        photo.processing = False
+    db.session.commit()
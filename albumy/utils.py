@@ -1,15 +1,33 @@
+import hashlib
+import mimetypes
 import os
 import re
+import tempfile
+from datetime import datetime
+from functools import partial
 from urllib.parse import urlparse, urljoin
 
 from PIL import Image
-from flask import request, redirect, url_for, flash, current_app
+from flask import request, redirect, url_for, flash, current_app, abort, safe_join, send_from_directory
 from flask_dropzone import random_filename
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, SignatureExpired, BadSignature
 
-from .extensions import db
-from .models import User
+from .blurhash import encode as encode_blurhash, dominant_color
+from .extensions import db, rendition_cache
+from .phash import dhash, dhash_pixels
+from .models import User, Photo
 from .settings import Operations
+from .storage import locate_file, storage_path, variant_name
+
+# 旧版本的Python不认识这两种图片格式
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+# 生成其它格式的图片时使用的参数
+VARIANT_OPTIONS = {
+    'webp': dict(quality=80, method=4),
+    'avif': dict(quality=60, speed=6),
+}
 
 
 def is_safe_url(target):
@@ -66,31 +84,250 @@ def flash_errors(form):
             flash('`%s`字段提交时出现错误:%s' % (getattr(form, field).label.text, error), 'danger')
 
 
-def resize_image(img, filename, base_width):
+def shrink_image(img, base_width):
+    """把图片按比例缩小到base_width宽, 返回新的图片对象.
+
+    JPEG在解码前先用draft按1/2, 1/4, 1/8的比例解码, 其它格式先用reduce做整数倍缩小,
+    最后再用LANCZOS缩放到精确尺寸, 避免在内存里展开整张原图.
+    """
+    h_size = int(float(img.size[1]) * base_width / float(img.size[0]))
+    img.draft(img.mode, (base_width, h_size))
+    factor = img.size[0] // (base_width * 2)
+    if factor > 1 and img.mode in ('L', 'LA', 'RGB', 'RGBA', 'CMYK'):
+        img = img.reduce(factor)
+    return img.resize((base_width, h_size), Image.LANCZOS)
+
+
+def resize_image(img, filename, base_width, upload_path, suffix):
+    """生成base_width宽的缩略图, 返回(文件名, 图片对象), 图片对象可以继续用来生成更小的尺寸"""
     filename, ext = os.path.splitext(filename)
     if img.size[0] < base_width:
-        return filename + ext
-    w_percent = (base_width / float(img.size[0]))
-    h_size = int((float(img.size[1])) * float(w_percent))
-    img = img.resize((base_width, h_size), Image.ANTIALIAS)
-    filename += current_app.config['ALBUMY_PHOTO_SUFFIX'][base_width] + ext
-    img.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename), optimize=True, quality=85)
+        return filename + ext, img
+    img = shrink_image(img, base_width)
+    filename += suffix + ext
+    img.save(storage_path(upload_path, filename), optimize=True, quality=85)
+    return filename, img
+
+
+def image_variants():
+    """ALBUMY_IMAGE_VARIANTS中当前的Pillow能够保存的格式"""
+    Image.init()
+    return [fmt for fmt in current_app.config['ALBUMY_IMAGE_VARIANTS'] if fmt.upper() in Image.SAVE]
+
+
+def save_variants(img, filename, upload_path, variants):
+    """把图片另存为variants中的格式, 不比原文件小的变体没有意义, 直接删除"""
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ('LA', 'PA') or 'transparency' in img.info else 'RGB')
+    size = file_size(upload_path, filename)
+    for fmt in variants:
+        path = storage_path(upload_path, variant_name(filename, fmt))
+        img.save(path, fmt.upper(), **VARIANT_OPTIONS.get(fmt, {}))
+        if os.path.getsize(path) >= size:
+            os.remove(path)
+
+
+def generate_thumbnails(filename, upload_path, sizes, suffixes, variants=()):
+    """根据原图生成中图和小图以及它们的其它格式, 不依赖应用上下文, 可以放到进程池中执行"""
+    with Image.open(os.path.join(upload_path, locate_file(upload_path, filename))) as img:
+        # 中图从原图生成, 小图从中图生成, 原图只解码一次
+        filename_m, img_m = resize_image(img, filename, sizes['medium'], upload_path, suffixes[sizes['medium']])
+        filename_s, img_s = resize_image(img_m, filename, sizes['small'], upload_path, suffixes[sizes['small']])
+        # 图片比小图还小时中图和小图都是原图
+        for name, derivative in {filename_m: img_m, filename_s: img_s}.items():
+            save_variants(derivative, name, upload_path, variants)
+        result = image_placeholder(img_s)
+    result.update(name_m=filename_m, name_s=filename_s,
+                  size_m=file_size(upload_path, filename_m), size_s=file_size(upload_path, filename_s))
+    return result
+
+
+def read_dhash_pixels(upload_path, filename):
+    """读取计算dHash用的像素, 不依赖应用上下文, 用于批量计算已有图片的感知哈希"""
+    with Image.open(os.path.join(upload_path, locate_file(upload_path, filename))) as img:
+        return dhash_pixels(img)
+
+
+def image_placeholder(img):
+    """图片加载完成之前显示的BlurHash和主色调, 从小图计算"""
+    return dict(blurhash=encode_blurhash(img), color=dominant_color(img))
+
+
+def read_photo_placeholder(upload_path, filename_s):
+    with Image.open(os.path.join(upload_path, locate_file(upload_path, filename_s))) as img:
+        return image_placeholder(img)
+
+
+def file_size(upload_path, filename):
+    return os.path.getsize(os.path.join(upload_path, locate_file(upload_path, filename)))
+
+
+def parse_exif_datetime(value):
+    try:
+        return datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+def image_metadata(img):
+    """读取已经打开的图片的尺寸, 格式和主要的EXIF信息, 只用到文件头, 不需要解码图片"""
+    try:
+        exif = img.getexif()
+        # DateTimeOriginal保存在Exif子IFD中, 没有时使用IFD0的DateTime
+        taken_at = exif.get_ifd(0x8769).get(0x9003) or exif.get(0x0132)
+    except Exception:
+        exif, taken_at = {}, None
+    make = str(exif.get(0x010F) or '').strip('\x00 ')
+    model = str(exif.get(0x0110) or '').strip('\x00 ')
+    camera = model if model.startswith(make) else ('%s %s' % (make, model)).strip()
+    return dict(
+        width=img.size[0],
+        height=img.size[1],
+        format=img.format,
+        orientation=exif.get(0x0112, 1),
+        camera=camera[:64] or None,
+        taken_at=parse_exif_datetime(taken_at) if taken_at else None,
+    )
+
+
+def read_photo_metadata(upload_path, filename, filename_m, filename_s):
+    """读取已保存的图片的元数据, 不依赖应用上下文, 用于补全已有的记录"""
+    path = os.path.join(upload_path, locate_file(upload_path, filename))
+    with Image.open(path) as img:
+        data = image_metadata(img)
+    data.update(filesize=os.path.getsize(path),
+                filesize_m=file_size(upload_path, filename_m),
+                filesize_s=file_size(upload_path, filename_s))
+    return data
+
+
+def save_by_digest(fp, upload_path):
+    """边读取边计算SHA-256, 用摘要作为文件名保存, 相同内容的文件只保存一份"""
+    sha256 = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=upload_path, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in iter(lambda: fp.stream.read(64 * 1024), b''):
+            sha256.update(chunk)
+            f.write(chunk)
+    filename = sha256.hexdigest() + os.path.splitext(fp.filename)[1].lower()
+    path = os.path.join(upload_path, locate_file(upload_path, filename))
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, storage_path(upload_path, filename))
     return filename
 
 
 def validate_image(fp):
-    try:
+    """保存上传的原图, 返回文件名, 文件大小和图片的元数据, 不是图片时返回None"""
+    upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+    if current_app.config['ALBUMY_DEDUPLICATE_UPLOADS']:
+        filename = save_by_digest(fp, upload_path)
+    else:
         filename = random_filename(fp.filename)
-        img = Image.open(fp)
-        fp.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename))
+        fp.save(storage_path(upload_path, filename))
+    path = os.path.join(upload_path, locate_file(upload_path, filename))
+    try:
+        with Image.open(path) as img:
+            data = image_metadata(img)
+            data['phash'] = dhash(img)
     except IOError:
+        os.remove(path)
         return None
-    img_m = img.copy()
-    img_s = img.copy()
-    img.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename))
-    filename_m = resize_image(img_m, filename, current_app.config['ALBUMY_PHOTO_SIZE']['medium'])
-    filename_s = resize_image(img_s, filename, current_app.config['ALBUMY_PHOTO_SIZE']['small'])
-    return dict(name=filename, name_m=filename_m, name_s=filename_s)
+    data.update(filename=filename, filesize=os.path.getsize(path))
+    return data
+
+
+def send_image(base_path, filename):
+    """发送上传的图片或头像. 文件名对应的内容不会改变, 所以允许浏览器长期缓存.
+
+    配置了ALBUMY_ACCEL_REDIRECT时只返回X-Accel-Redirect头, 由nginx发送文件,
+    否则由send_from_directory交给WSGI服务器的wsgi.file_wrapper发送.
+    """
+    relative_path = locate_file(base_path, filename)
+    cache_timeout = current_app.config['ALBUMY_IMAGE_CACHE_TIMEOUT']
+    accel_redirect = current_app.config['ALBUMY_ACCEL_REDIRECT']
+    path = safe_join(base_path, relative_path)
+    location = os.path.relpath(path, current_app.config['ALBUMY_UPLOAD_PATH'])
+    if accel_redirect and not location.startswith(os.pardir):
+        if not os.path.isfile(path):
+            abort(404)
+        response = current_app.response_class(mimetype=mimetypes.guess_type(path)[0])
+        response.headers['X-Accel-Redirect'] = accel_redirect.rstrip('/') + '/' + location.replace(os.sep, '/')
+        response.set_etag('%s-%s' % (os.path.getmtime(path), os.path.getsize(path)))
+        response.cache_control.public = True
+        response.cache_control.max_age = cache_timeout
+        response.make_conditional(request)
+        if response.status_code == 304:
+            del response.headers['X-Accel-Redirect']
+    else:
+        response = send_from_directory(base_path, relative_path, cache_timeout=cache_timeout)
+    response.cache_control.immutable = True
+    return response
+
+
+def send_negotiated_image(base_path, filename):
+    """按Accept头发送浏览器支持的其它格式, 只认明确列出的类型, 不认image/*和*/*"""
+    accepted = set(mimetype for mimetype, quality in request.accept_mimetypes if quality > 0)
+    available = [fmt for fmt in current_app.config['ALBUMY_IMAGE_VARIANTS']
+                 if os.path.exists(os.path.join(base_path, locate_file(base_path, variant_name(filename, fmt))))]
+    chosen = next((variant_name(filename, fmt) for fmt in available if 'image/' + fmt in accepted), filename)
+    response = send_image(base_path, chosen)
+    if available:
+        response.vary.add('Accept')
+    return response
+
+
+def rendition_source(upload_path, filename, width):
+    """返回生成width宽的图片时使用的文件和它的宽度: 不小于width的最小的已保存尺寸, 都没有时使用原图.
+    已保存的尺寸正好是配置的宽度, 原图的宽度不知道, 返回None
+    """
+    name, ext = os.path.splitext(filename)
+    suffixes = current_app.config['ALBUMY_PHOTO_SUFFIX']
+    for size in sorted(current_app.config['ALBUMY_PHOTO_SIZE'].values()):
+        if size < width:
+            continue
+        candidate = name + suffixes[size] + ext
+        if os.path.exists(os.path.join(upload_path, locate_file(upload_path, candidate))):
+            return candidate, size
+    return filename, None
+
+
+def render_rendition(source_path, width, path):
+    with Image.open(source_path) as img:
+        shrink_image(img, width).save(path, img.format, optimize=True, quality=85)
+
+
+def send_resized_image(filename, width):
+    """发送width宽的图片, 第一次请求时从已保存的尺寸生成并放到磁盘缓存中"""
+    if width not in current_app.config['ALBUMY_PHOTO_WIDTHS']:
+        abort(404)
+    name, ext = os.path.splitext(filename)
+    rendition = '%s_w%d%s' % (name, width, ext)
+    # 已经生成过时直接发送, 不需要打开原图
+    if rendition_cache.lookup(rendition) is not None:
+        return send_image(current_app.config['ALBUMY_RENDITION_PATH'], rendition)
+    upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+    source, source_width = rendition_source(upload_path, filename, width)
+    source_path = safe_join(upload_path, locate_file(upload_path, source))
+    if source_width is None:
+        # 原图优先使用上传时保存的宽度, 去重后多张图片共用一个文件, 宽度都相同, 取一条即可.
+        # 没有记录时才读取图片的头部
+        source_width = db.session.query(Photo.width).filter_by(filename=filename).limit(1).scalar()
+    if source_width is None:
+        try:
+            with Image.open(source_path) as img:
+                source_width = img.size[0]
+        except IOError:
+            abort(404)
+    if source_width <= width:
+        # 不放大图片, 宽度相同的已保存尺寸也不重新编码, 直接发送已保存的文件
+        return send_image(upload_path, source)
+    try:
+        rendition_cache.get(rendition, partial(render_rendition, source_path, width))
+    except IOError:
+        abort(404)
+    return send_image(current_app.config['ALBUMY_RENDITION_PATH'], rendition)
 
 
 def validate_email(email):
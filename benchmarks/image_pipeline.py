@@ -0,0 +1,118 @@
+"""对比上传图片的旧处理流程和现在的流程
+
+    python benchmarks/image_pipeline.py [--runs 5] [--width 4032] [--height 3024]
+
+每个流程都在单独的子进程里运行, 这样两边的峰值内存(ru_maxrss)互不影响.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+from werkzeug.datastructures import FileStorage  # noqa: E402
+
+
+def make_photo(width, height):
+    """生成一张带噪点的JPEG, 大小接近手机拍摄的照片"""
+    img = Image.effect_noise((width, height), 64).convert('RGB')
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, 97):
+        draw.line([(i, 0), (width - i, height)], fill=(i % 255, 80, 160), width=9)
+    img = img.filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def legacy_validate_image(fp):
+    """改动之前的validate_image: 原图写两次, 复制两份完整的原图再分别缩放"""
+    from flask import current_app
+    from flask_dropzone import random_filename
+
+    def resize_image(img, filename, base_width):
+        filename, ext = os.path.splitext(filename)
+        if img.size[0] < base_width:
+            return filename + ext
+        w_percent = (base_width / float(img.size[0]))
+        h_size = int((float(img.size[1])) * float(w_percent))
+        img = img.resize((base_width, h_size), Image.LANCZOS)
+        filename += current_app.config['ALBUMY_PHOTO_SUFFIX'][base_width] + ext
+        img.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename), optimize=True, quality=85)
+        return filename
+
+    try:
+        filename = random_filename(fp.filename)
+        img = Image.open(fp)
+        fp.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename))
+    except IOError:
+        return None
+    img_m = img.copy()
+    img_s = img.copy()
+    img.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename))
+    filename_m = resize_image(img_m, filename, current_app.config['ALBUMY_PHOTO_SIZE']['medium'])
+    filename_s = resize_image(img_s, filename, current_app.config['ALBUMY_PHOTO_SIZE']['small'])
+    return dict(name=filename, name_m=filename_m, name_s=filename_s)
+
+
+def current_validate_image(fp):
+    """现在的流程: validate_image保存原图, generate_thumbnails生成中图和小图(上传时在进程池里执行)"""
+    from flask import current_app
+    from albumy.utils import validate_image, generate_thumbnails
+
+    filename = validate_image(fp)['filename']
+    return generate_thumbnails(filename, current_app.config['ALBUMY_UPLOAD_PATH'],
+                               current_app.config['ALBUMY_PHOTO_SIZE'], current_app.config['ALBUMY_PHOTO_SUFFIX'])
+
+
+def run(name, data, runs, queue):
+    from albumy import create_app
+
+    func = legacy_validate_image if name == 'legacy' else current_validate_image
+    upload_path = tempfile.mkdtemp()
+    app = create_app('testing')
+    app.config['ALBUMY_UPLOAD_PATH'] = upload_path
+
+    with app.app_context():
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        timings = []
+        for _ in range(runs):
+            fp = FileStorage(stream=io.BytesIO(data), filename='photo.jpg')
+            start = time.perf_counter()
+            func(fp)
+            timings.append(time.perf_counter() - start)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    shutil.rmtree(upload_path)
+    queue.put((name, min(timings), sum(timings) / len(timings), peak / 1024.0, (peak - baseline) / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--width', type=int, default=4032)
+    parser.add_argument('--height', type=int, default=3024)
+    args = parser.parse_args()
+
+    data = make_photo(args.width, args.height)
+    print('photo: %dx%d, %.2f MB, %d runs' % (args.width, args.height, len(data) / 1024.0 / 1024.0, args.runs))
+    print('%-10s %10s %10s %14s %14s' % ('pipeline', 'best(ms)', 'mean(ms)', 'peak RSS(MB)', 'RSS growth(MB)'))
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    for name in ('legacy', 'current'):
+        process = ctx.Process(target=run, args=(name, data, args.runs, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        print('%-10s %10.1f %10.1f %14.1f %14.1f' % (result[0], result[1] * 1000, result[2] * 1000, result[3], result[4]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,31 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
 from flask import url_for
+from flask_sqlalchemy import get_debug_queries
 
 from albumy import create_app
-from albumy.extensions import db
+from albumy.extensions import db, memory_cache
 from albumy.models import Role, User, Photo, Comment, Tag
 
 
 class BaseTestCase(TestCase):
     def setUp(self) -> None:
         app = create_app('testing')
+        # 上传的图片和生成的头像写入临时目录, 不写入仓库中的uploads
+        upload_path = self.make_temp_dir()
+        app.config['ALBUMY_UPLOAD_PATH'] = upload_path
+        app.config['AVATARS_SAVE_PATH'] = os.path.join(upload_path, 'avatars')
+        app.config['ALBUMY_RENDITION_PATH'] = os.path.join(upload_path, 'renditions')
+        os.makedirs(app.config['AVATARS_SAVE_PATH'])
         self.context = app.test_request_context()
         self.context.push()
         self.client = app.test_client()
         self.runner = app.test_cli_runner()
+        # memory_cache在整个进程中共用, 不能带到下一个测试中
+        memory_cache.clear()
 
         db.create_all()
         Role.init_role()
@@ -52,8 +64,15 @@ class BaseTestCase(TestCase):
 
     def tearDown(self) -> None:
         db.drop_all()
+        memory_cache.clear()
         self.context.pop()
 
+    def make_temp_dir(self):
+        """创建一个临时目录, 测试结束后删除"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        return path
+
     def login(self, email='normal@helloflask.com', password='12345678'):
         return self.client.post(url_for('auth.login'), data=dict(
             email=email,
@@ -62,3 +81,10 @@ class BaseTestCase(TestCase):
 
     def logout(self):
         return self.client.get(url_for('auth.logout'), follow_redirects=True)
+
+    def count_queries(self, url):
+        # 和实际的请求一样从空的session开始
+        db.session.expunge_all()
+        start = len(get_debug_queries())
+        self.client.get(url)
+        return len(get_debug_queries()) - start
@@ -1,6 +1,7 @@
-from flask import url_for
+from flask import url_for, current_app
 
-from albumy.models import User, Role, Tag
+from albumy.extensions import db
+from albumy.models import User, Role, Tag, Photo, Permission
 from .base import BaseTestCase
 
 
@@ -35,6 +36,22 @@ class AdminTestCase(BaseTestCase):
         user = User.query.get(4)
         self.assertEqual(user.role.name, 'Normal')
 
+    def test_role_permissions_cache(self):
+        current_app.config['ALBUMY_ROLE_CACHE_TIMEOUT'] = 600
+        user = User.query.get(2)
+        self.assertTrue(user.can('UPLOAD'))
+        self.assertFalse(user.can('MODERATE'))
+        self.assertFalse(user.can('NONEXISTENT'))
+
+        role = Role.query.filter_by(name='Normal').first()
+        role.permissions.remove(Permission.query.filter_by(name='UPLOAD').first())
+        db.session.commit()
+        self.assertFalse(user.can('UPLOAD'))
+
+        role.permissions.append(Permission.query.filter_by(name='MODERATE').first())
+        db.session.rollback()
+        self.assertFalse(user.can('MODERATE'))
+
     def test_block_user(self):
         response = self.client.post(url_for('admin.block_user', user_id=2), follow_redirects=True)
         self.assertIn('用户被封禁', response.get_data(as_text=True))
@@ -108,6 +125,25 @@ class AdminTestCase(BaseTestCase):
         response = self.client.get(url_for('admin.manage_photo', order='by_time'))
         self.assertIn('上传时间', response.get_data(as_text=True))
 
+    def test_similar_photos(self):
+        photo = Photo.query.get(1)
+        photo.phash = '0f0f0f0f0f0f0f0f'
+        Photo.query.get(2).phash = '0f0f0f0f0f0f0f0e'
+        db.session.add(Photo(filename='test3.jpg', filename_s='test3_s.jpg', filename_m='test3_m.jpg',
+                             phash='f0f0f0f0f0f0f0f0'))
+        db.session.commit()
+        self.assertEqual([p.id for p in photo.similar_photos()], [2])
+        self.assertEqual(Photo.find_similar('0f0f0f0f0f0f0f0f', distance=0), [photo])
+        self.assertRaises(ValueError, Photo.find_similar, '0f0f0f0f0f0f0f0f', distance=4)
+
+        response = self.client.get(url_for('admin.manage_photo'))
+        self.assertIn(url_for('admin.similar_photos', photo_id=1), response.get_data(as_text=True))
+        response = self.client.get(url_for('admin.similar_photos', photo_id=1))
+        data = response.get_data(as_text=True)
+        self.assertIn('相似图片', data)
+        self.assertIn('test2_s.jpg', data)
+        self.assertNotIn('test3_s.jpg', data)
+
     def test_manage_user(self):
         response = self.client.get(url_for('admin.manage_user'))
         data = response.get_data(as_text=True)
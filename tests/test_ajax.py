@@ -1,6 +1,8 @@
-from flask import url_for
+from flask import url_for, current_app
 
+from albumy.extensions import db
 from albumy.models import User, Photo
+from albumy.notifications import push_follow_notification
 from .base import BaseTestCase
 
 
@@ -52,9 +54,25 @@ class AjaxTestCase(BaseTestCase):
         response = self.client.get(url_for('ajax.followers_count', user_id=1))
         self.assertEqual(response.get_json().get('count'), 0)
 
+        self.client.post(url_for('ajax.follow', username='guoxy2016'))
+        response = self.client.get(url_for('ajax.followers_count', user_id=1))
+        self.assertEqual(response.get_json().get('count'), 1)
+        self.assertEqual(User.query.get(2).following_count, 1)
+
+        self.client.post(url_for('ajax.unfollow', username='guoxy2016'))
+        response = self.client.get(url_for('ajax.followers_count', user_id=1))
+        self.assertEqual(response.get_json().get('count'), 0)
+        self.assertEqual(User.query.get(2).following_count, 0)
+
     def test_notifications_count(self):
+        current_app.config['ALBUMY_USER_CACHE_TIMEOUT'] = 60
         response = self.client.get(url_for('ajax.notifications_count'))
         self.assertEqual(response.get_json().get('count'), 0)
+        # 未读计数不在用户快照中, 快照缓存期间也返回最新的值
+        push_follow_notification(User.query.get(1), User.query.get(2))
+        db.session.commit()
+        response = self.client.get(url_for('ajax.notifications_count'))
+        self.assertEqual(response.get_json().get('count'), 1)
         self.logout()
         response = self.client.get(url_for('ajax.notifications_count'))
         self.assertEqual(response.get_json().get('message'), '用户未登录')
@@ -96,3 +114,9 @@ class AjaxTestCase(BaseTestCase):
         response = self.client.get(url_for('ajax.collectors_count', photo_id=1))
         self.assertEqual(response.get_json().get('count'), len(Photo.query.get(1).collectors))
 
+    def test_photo_status(self):
+        response = self.client.get(url_for('ajax.photo_status', photo_id=1))
+        data = response.get_json()
+        self.assertFalse(data.get('processing'))
+        self.assertIn('test_m.jpg', data.get('filename_m'))
+        self.assertIn('test_s.jpg', data.get('filename_s'))
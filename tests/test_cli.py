@@ -1,6 +1,21 @@
-from albumy.models import db, User, Photo, Tag, Comment, Follow
+import os
+import unittest
+from datetime import datetime, timedelta
+
+from PIL import Image
+
+from flask import current_app
+
+from albumy.models import db, User, Photo, Tag, Comment, Follow, Timeline, Notification
+from albumy.phash import dhash, dhash_many, dhash_pixels, pixels_hash
+from albumy.storage import shard_path, storage_path
 from .base import BaseTestCase
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class CliTestCase(BaseTestCase):
 
@@ -87,3 +102,167 @@ class CliTestCase(BaseTestCase):
         result = self.runner.invoke(args=['forge', '--follow', '13'])
         self.assertIn('Generating 13 follows', result.output)
         self.assertLessEqual(Follow.query.count(), 13 + 6 + 1)
+
+    def test_cli_shard_uploads(self):
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        for filename in ['a.jpg', 'a_s.jpg', 'a_m.jpg']:
+            open(os.path.join(upload_path, filename), 'wb').close()
+        open(os.path.join(upload_path, 'avatars', 'a_s.png'), 'wb').close()
+
+        result = self.runner.invoke(args=['shard-uploads', '--batch-size', '2'])
+        self.assertIn('3 files moved', result.output)
+        self.assertIn('1 files moved', result.output)
+        for filename in ['a.jpg', 'a_s.jpg', 'a_m.jpg']:
+            self.assertFalse(os.path.exists(os.path.join(upload_path, filename)))
+            self.assertTrue(os.path.exists(os.path.join(upload_path, shard_path(filename))))
+        self.assertTrue(os.path.exists(os.path.join(upload_path, 'avatars', shard_path('a_s.png'))))
+
+        result = self.runner.invoke(args=['shard-uploads'])
+        self.assertNotIn('files moved', result.output)
+        self.assertIn('Done', result.output)
+
+    def test_cli_backfill_metadata(self):
+        db.create_all()
+        db.session.add(Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg'))
+        db.session.add(Photo(filename='test2.jpg', filename_s='test2.jpg', filename_m='test2.jpg'))
+        db.session.commit()
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        Image.new('RGB', (640, 480)).save(storage_path(upload_path, 'test.jpg'))
+        Image.new('RGB', (400, 300)).save(storage_path(upload_path, 'test_s.jpg'))
+        Image.new('RGB', (800, 600)).save(storage_path(upload_path, 'test_m.jpg'))
+
+        result = self.runner.invoke(args=['backfill-metadata', '--workers', '1'])
+        self.assertIn('test2.jpg: cannot read the photo', result.output)
+        self.assertIn('1 photos updated', result.output)
+        photo = Photo.query.get(1)
+        self.assertEqual((photo.width, photo.height, photo.format), (640, 480, 'JPEG'))
+        self.assertEqual(photo.filesize_s, os.path.getsize(os.path.join(upload_path, shard_path('test_s.jpg'))))
+        self.assertIsNone(Photo.query.get(2).width)
+
+    def test_cli_backfill_placeholders(self):
+        db.create_all()
+        db.session.add(Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg'))
+        db.session.add(Photo(filename='test2.jpg', filename_s='test2_s.jpg', filename_m='test2_m.jpg',
+                             processing=True))
+        db.session.commit()
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        Image.new('RGB', (400, 300), (10, 200, 30)).save(storage_path(upload_path, 'test_s.jpg'))
+
+        result = self.runner.invoke(args=['backfill-placeholders', '--workers', '1'])
+        self.assertIn('1 photos updated', result.output)
+        photo = Photo.query.get(1)
+        self.assertTrue(photo.blurhash.startswith('L'))
+        self.assertEqual(photo.color, '#0ac81e')
+        self.assertIsNone(Photo.query.get(2).blurhash)
+
+    def test_cli_build_phash(self):
+        db.create_all()
+        db.session.add(Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg'))
+        db.session.add(Photo(filename='test2.jpg', filename_s='test2_s.jpg', filename_m='test2_m.jpg'))
+        db.session.commit()
+        upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
+        img = Image.linear_gradient('L').rotate(45).resize((640, 480)).convert('RGB')
+        img.save(storage_path(upload_path, 'test.jpg'))
+
+        result = self.runner.invoke(args=['build-phash', '--workers', '1'])
+        self.assertIn('test2.jpg: cannot read the photo', result.output)
+        self.assertIn('1 photos hashed', result.output)
+        photo = Photo.query.get(1)
+        self.assertEqual(photo.phash, dhash(Image.open(os.path.join(upload_path, shard_path('test.jpg')))))
+        self.assertNotEqual(photo.phash, '0' * 16)
+        self.assertIsNotNone(photo.phash_3)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_dhash_many_numpy(self):
+        # NumPy批量计算的结果和逐张计算的结果相同
+        images = [Image.linear_gradient('L').rotate(angle).resize((640, 480)) for angle in (0, 45, 90, 200)]
+        images.append(Image.effect_noise((320, 240), 64))
+        pixels = [dhash_pixels(img) for img in images]
+        self.assertEqual(dhash_many(pixels), [pixels_hash(item) for item in pixels])
+
+    def test_cli_reconcile_counters(self):
+        self.runner.invoke(args=['init'])
+        user = User(email='a@helloflask.com', name='A', username='a')
+        other = User(email='b@helloflask.com', name='B', username='b')
+        db.session.add_all([user, other])
+        db.session.commit()
+        user.follow(other)
+        photo = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg', author=user,
+                      tags=[Tag(name='tag')])
+        db.session.add(photo)
+        db.session.commit()
+        other.collect(photo)
+        db.session.add(Comment(body='comment', photo=photo, author=other))
+        db.session.add(Notification(message='notification', receiver=user))
+        db.session.commit()
+
+        result = self.runner.invoke(args=['reconcile-counters'])
+        self.assertIn('photo.collect_count: 0 rows fixed', result.output)
+        self.assertIn('user.follower_count: 0 rows fixed', result.output)
+        self.assertIn('user.photo_count: 0 rows fixed', result.output)
+        self.assertIn('user.collection_count: 0 rows fixed', result.output)
+
+        Photo.query.update({Photo.collect_count: 10, Photo.comment_count: None})
+        Tag.query.update({Tag.photo_count: 3})
+        User.query.update({User.follower_count: 0, User.following_count: 5, User.unread_notification_count: 1,
+                           User.photo_count: 1, User.collection_count: None})
+        db.session.commit()
+        result = self.runner.invoke(args=['reconcile-counters'])
+        self.assertIn('photo.collect_count: 1 rows fixed', result.output)
+        self.assertIn('photo.comment_count: 1 rows fixed', result.output)
+        self.assertIn('tag.photo_count: 1 rows fixed', result.output)
+        self.assertIn('user.follower_count: 1 rows fixed', result.output)
+        self.assertIn('user.following_count: 2 rows fixed', result.output)
+        self.assertIn('user.unread_notification_count: 1 rows fixed', result.output)
+        self.assertIn('user.photo_count: 1 rows fixed', result.output)
+        self.assertIn('user.collection_count: 2 rows fixed', result.output)
+        photo = Photo.query.first()
+        self.assertEqual((photo.collect_count, photo.comment_count), (1, 1))
+        self.assertEqual(Tag.query.first().photo_count, 1)
+        user, other = User.query.filter_by(username='a').one(), User.query.filter_by(username='b').one()
+        self.assertEqual((user.follower_count, user.following_count), (0, 1))
+        self.assertEqual((other.follower_count, other.following_count), (1, 0))
+        self.assertEqual((user.photo_count, user.collection_count), (1, 0))
+        self.assertEqual((other.photo_count, other.collection_count), (0, 1))
+
+    def test_cli_rebuild_timeline(self):
+        self.runner.invoke(args=['init'])
+        user = User(email='a@helloflask.com', name='A', username='a')
+        other = User(email='b@helloflask.com', name='B', username='b')
+        db.session.add_all([user, other])
+        db.session.commit()
+        user.follow(other)
+        user_id = user.id
+        db.session.add_all([Photo(filename='%d.jpg' % i, author=other) for i in range(3)])
+        db.session.commit()
+        Timeline.query.delete()
+        db.session.commit()
+
+        result = self.runner.invoke(args=['rebuild-timeline', '--batch-size', '1'])
+        self.assertIn('6 timeline rows created', result.output)
+        self.assertIn('Done!', result.output)
+        self.assertEqual(Timeline.query.filter_by(user_id=user_id).count(), 3)
+
+        current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT'] = 0
+        result = self.runner.invoke(args=['rebuild-timeline'])
+        self.assertIn('0 timeline rows created', result.output)
+
+    def test_cli_purge_notifications(self):
+        self.runner.invoke(args=['init'])
+        user = User(email='a@helloflask.com', name='A', username='a')
+        old = datetime.utcnow() - timedelta(days=40)
+        db.session.add_all([Notification(message='old read %d' % i, receiver=user, is_read=True, timestamp=old)
+                            for i in range(3)])
+        db.session.add_all([Notification(message='old unread', receiver=user, timestamp=old),
+                            Notification(message='new read', receiver=user, is_read=True)])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['notifications', 'purge', '--batch-size', '2'])
+        self.assertIn('3 notifications deleted', result.output)
+        self.assertIn('Done!', result.output)
+        self.assertEqual(sorted(n.message for n in Notification.query), ['new read', 'old unread'])
+        self.assertEqual(User.query.filter_by(username='a').one().unread_notification_count, 1)
+
+        result = self.runner.invoke(args=['notifications', 'purge', '--older-than', '0'])
+        self.assertIn('1 notifications deleted', result.output)
+        self.assertEqual(Notification.query.count(), 1)
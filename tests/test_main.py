@@ -1,7 +1,19 @@
-from flask import url_for
-
-from albumy.extensions import db
-from albumy.models import User, Notification, Photo, Comment, Tag
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from PIL import Image
+from flask import url_for, current_app
+
+from albumy.extensions import db, rendition_cache
+from albumy.models import User, Notification, Photo, Comment, Tag, Timeline
+from albumy.notifications import push_collect_notification, push_follow_notification
+from albumy.pagination import _after, dump_cursor
+from albumy.storage import shard_path, storage_path, variant_name
 from .base import BaseTestCase
 
 
@@ -18,11 +30,370 @@ class MainTestCase(BaseTestCase):
         self.assertNotIn('现在注册', data)
         self.assertIn('主页', data)
 
+    def test_index_popular_tags(self):
+        current_app.config['ALBUMY_POPULAR_TAGS_TIMEOUT'] = 300
+        self.login(email='admin@helloflask.com')
+        self.assertIn('test tag', self.client.get(url_for('main.index')).get_data(as_text=True))
+
+        # 绕过ORM的修改不会让缓存失效
+        Tag.query.filter_by(id=1).update({Tag.name: 'renamed tag'}, synchronize_session=False)
+        db.session.commit()
+        self.assertIn('test tag', self.client.get(url_for('main.index')).get_data(as_text=True))
+
+        self.client.post(url_for('main.new_tag', photo_id=1), data=dict(tag='hello'))
+        data = self.client.get(url_for('main.index')).get_data(as_text=True)
+        self.assertIn('renamed tag', data)
+        self.assertIn('hello', data)
+
+        self.client.post(url_for('main.delete_tag', photo_id=1, tag_id=Tag.query.filter_by(name='hello').first().id))
+        self.assertNotIn('hello', self.client.get(url_for('main.index')).get_data(as_text=True))
+
+    def test_index_cursor(self):
+        admin = User.query.get(1)
+        User.query.get(2).follow(admin)
+        # 时间相同的图片按id排序, 翻页时不会重复或遗漏
+        timestamp = Photo.query.get(1).timestamp
+        for i in range(15):
+            db.session.add(Photo(filename='%d.jpg' % i, filename_s='%d_s.jpg' % i, filename_m='%d_m.jpg' % i,
+                                 author=admin, timestamp=timestamp))
+        db.session.commit()
+
+        self.login()
+        response = self.client.get(url_for('main.index'))
+        data = response.get_data(as_text=True)
+        first_page = re.findall(r'photo/(\d+)"', data)
+        self.assertEqual(len(set(first_page)), 12)
+        next_cursor = re.search(r'cursor=([\w-]+)', data).group(1)
+
+        response = self.client.get(url_for('main.index', cursor=next_cursor))
+        data = response.get_data(as_text=True)
+        second_page = re.findall(r'photo/(\d+)"', data)
+        self.assertEqual(len(set(second_page)), 5)
+        self.assertEqual(set(first_page) | set(second_page), {str(photo.id) for photo in Photo.query.all()})
+
+        response = self.client.get(url_for('main.index', cursor='invalid'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_keyset_query_plan(self):
+        # 深的游标也应该直接在索引中定位(SEARCH), 不能扫描整个索引(SCAN)
+        timestamp = Photo.query.get(1).timestamp
+        queries = [
+            (Photo.query, (Photo.timestamp, Photo.id), (timestamp, 1)),
+            (Photo.query.filter_by(author_id=1), (Photo.timestamp, Photo.id), (timestamp, 1)),
+            (Photo.query, (Photo.collect_count, Photo.id), (0, 1)),
+            (Timeline.query.filter_by(user_id=1), (Timeline.timestamp, Timeline.photo_id), (timestamp, 1)),
+        ]
+        for query, columns, values in queries:
+            query = query.filter(_after(columns, values)).order_by(*[column.desc() for column in columns]).limit(13)
+            compiled = query.statement.compile(db.engine)
+            plan = ' '.join(row[-1] for row in db.session.connection().execute(
+                'EXPLAIN QUERY PLAN ' + str(compiled), *[compiled.params[name] for name in compiled.positiontup]))
+            self.assertIn('SEARCH', plan)
+            self.assertNotIn('SCAN', plan)
+
+    def test_index_timeline(self):
+        admin = User.query.get(1)
+        normal = User.query.get(2)
+        photo_link = lambda photo_id: '%s"' % url_for('main.show_photo', photo_id=photo_id)
+        self.login()
+        self.assertNotIn(photo_link(1), self.client.get(url_for('main.index')).get_data(as_text=True))
+
+        normal.follow(admin)
+        self.assertIn(photo_link(1), self.client.get(url_for('main.index')).get_data(as_text=True))
+        photo = Photo(filename='3.jpg', filename_s='3_s.jpg', filename_m='3_m.jpg', author=admin)
+        db.session.add(photo)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(photo_id=photo.id).count(), 2)
+        data = self.client.get(url_for('main.index')).get_data(as_text=True)
+        self.assertIn(photo_link(1), data)
+        self.assertIn(photo_link(3), data)
+
+        db.session.delete(photo)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(photo_id=3).count(), 0)
+
+        # 粉丝数超过限制的用户的图片不写入时间线, 读取时合并
+        current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT'] = 0
+        User.query.get(3).follow(admin)
+        self.assertTrue(User.query.get(1).celebrity)
+        photo = Photo(filename='4.jpg', filename_s='4_s.jpg', filename_m='4_m.jpg', author=admin)
+        db.session.add(photo)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(photo_id=photo.id).count(), 0)
+        data = self.client.get(url_for('main.index')).get_data(as_text=True)
+        self.assertIn(photo_link(photo.id), data)
+        self.assertIn(photo_link(2), data)
+
+        # 粉丝数降到限制的一半以下时取消标记, 补齐之前继续合并读取, 由backfill-timeline补齐时间线
+        current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT'] = 4
+        photo_id = photo.id
+        User.query.get(3).unfollow(User.query.get(1))
+        self.assertFalse(User.query.get(1).celebrity)
+        self.assertTrue(User.query.get(1).timeline_backfill)
+        self.assertEqual(Timeline.query.filter_by(user_id=2, photo_id=photo_id).count(), 0)
+        self.assertIn(photo_link(photo_id), self.client.get(url_for('main.index')).get_data(as_text=True))
+        result = self.runner.invoke(args=['backfill-timeline', '--batch-size', '1'])
+        self.assertIn('guoxy2016: 2 timeline rows created', result.output)
+        self.assertFalse(User.query.get(1).timeline_backfill)
+        self.assertEqual(Timeline.query.filter_by(user_id=2, photo_id=photo_id).count(), 1)
+        self.assertEqual(Timeline.query.filter_by(user_id=2, photo_id=1).count(), 1)
+        self.assertIn(photo_link(photo_id), self.client.get(url_for('main.index')).get_data(as_text=True))
+
+        normal = User.query.get(2)
+        admin = User.query.get(1)
+        normal.unfollow(admin)
+        self.assertEqual(Timeline.query.filter_by(user_id=2, photo_id=1).count(), 0)
+        data = self.client.get(url_for('main.index')).get_data(as_text=True)
+        self.assertNotIn(photo_link(1), data)
+        self.assertNotIn(photo_link(photo_id), data)
+        self.assertIn(photo_link(2), data)
+
+    def test_upload(self):
+        buffer = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x010F] = 'Canon'
+        exif[0x0110] = 'Canon EOS 5D'
+        exif[0x0112] = 6
+        exif[0x0132] = '2020:05:01 08:30:00'
+        Image.new('RGB', (1000, 600), (120, 80, 40)).save(buffer, 'JPEG', exif=exif)
+
+        self.login()
+        response = self.client.post(url_for('main.upload'), data={'file': (io.BytesIO(buffer.getvalue()), 'test.jpg')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200)
+        photo = Photo.query.get(3)
+        self.assertTrue(photo.filename_m.endswith('_m.jpg'))
+        self.assertTrue(photo.filename_s.endswith('_s.jpg'))
+        self.assertEqual((photo.width, photo.height, photo.format), (1000, 600, 'JPEG'))
+        self.assertEqual(photo.filesize, len(buffer.getvalue()))
+        self.assertLess(photo.filesize_s, photo.filesize_m)
+        self.assertEqual(photo.orientation, 6)
+        self.assertEqual(photo.camera, 'Canon EOS 5D')
+        self.assertEqual(photo.taken_at.year, 2020)
+        self.assertEqual(len(photo.blurhash), 28)
+        self.assertRegex(photo.color, '^#[0-9a-f]{6}$')
+        response = self.client.get(url_for('main.show_photo', photo_id=3))
+        self.assertIn('data-blurhash="%s"' % photo.blurhash, response.get_data(as_text=True))
+        response = self.client.get(url_for('main.get_image', filename=photo.filename_s))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertIn('Accept', response.headers['Vary'])
+        response = self.client.get(url_for('main.get_image', filename=photo.filename_s),
+                                   headers={'Accept': 'image/webp,image/*,*/*;q=0.8'})
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertIn('Accept', response.headers['Vary'])
+        self.assertEqual(Image.open(io.BytesIO(response.get_data())).format, 'WEBP')
+
+        response = self.client.post(url_for('main.upload'), data={'file': (io.BytesIO(b'abcdef'), 'bad.jpg')},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+        self.assertIsNone(Photo.query.get(4))
+
+    def test_upload_similar(self):
+        self.login()
+        for brightness in (0, 8):
+            buffer = io.BytesIO()
+            img = Image.linear_gradient('L').rotate(30).resize((600, 400)).point(lambda v: min(255, v + brightness))
+            img.convert('RGB').save(buffer, 'JPEG')
+            response = self.client.post(url_for('main.upload'),
+                                        data={'file': (io.BytesIO(buffer.getvalue()), 'test.jpg')},
+                                        content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 200)
+        photo3 = Photo.query.get(3)
+        photo4 = Photo.query.get(4)
+        self.assertEqual(len(photo3.phash), 16)
+        self.assertEqual(photo3.phash_0, int(photo3.phash[:4], 16))
+        self.assertEqual(photo3.similar_photos(), [photo4])
+
+        response = self.client.get(url_for('main.index'))
+        self.assertIn('上传的图片和已有的图片非常相似', response.get_data(as_text=True))
+
+    def test_upload_deduplicate(self):
+        current_app.config['ALBUMY_DEDUPLICATE_UPLOADS'] = True
+        buffer = io.BytesIO()
+        Image.new('RGB', (1000, 600), (10, 20, 30)).save(buffer, 'JPEG')
+
+        self.login()
+        for _ in range(2):
+            self.client.post(url_for('main.upload'), data={'file': (io.BytesIO(buffer.getvalue()), 'same.JPG')},
+                             content_type='multipart/form-data')
+        photo3 = Photo.query.get(3)
+        photo4 = Photo.query.get(4)
+        self.assertEqual(photo3.filename, photo4.filename)
+        self.assertEqual(photo3.filename_s, photo4.filename_s)
+        self.assertTrue(photo3.filename.endswith('.jpg'))
+        path = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], shard_path(photo3.filename_s))
+        webp_path = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'],
+                                 shard_path(variant_name(photo3.filename_s, 'webp')))
+        self.assertTrue(os.path.exists(webp_path))
+
+        self.client.post(url_for('main.delete_photo', photo_id=3))
+        self.assertTrue(os.path.exists(path))
+        self.client.post(url_for('main.delete_photo', photo_id=4))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(webp_path))
+
+    def test_get_image(self):
+        with open(storage_path(current_app.config['ALBUMY_UPLOAD_PATH'], 'test_s.jpg'), 'wb') as f:
+            f.write(b'image data')
+
+        response = self.client.get(url_for('main.get_image', filename='test_s.jpg'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+
+        response = self.client.get(url_for('main.get_image', filename='test_s.jpg'), headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        current_app.config['ALBUMY_ACCEL_REDIRECT'] = '/protected-uploads'
+        response = self.client.get(url_for('main.get_image', filename='test_s.jpg'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/protected-uploads/' + shard_path('test_s.jpg'))
+        self.assertEqual(response.get_data(), b'')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+        response = self.client.get(url_for('main.get_image', filename='test_s.jpg'),
+                                   headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+
+        response = self.client.get(url_for('main.get_image', filename='nothing.jpg'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_resized_image(self):
+        rendition_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, rendition_path)
+        current_app.config['ALBUMY_RENDITION_PATH'] = rendition_path
+        Image.new('RGB', (1000, 500)).save(storage_path(current_app.config['ALBUMY_UPLOAD_PATH'], 'test.jpg'))
+
+        response = self.client.get(url_for('main.get_resized_image', filename='test.jpg', width=600))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(Image.open(io.BytesIO(response.get_data())).size, (600, 300))
+        self.assertTrue(os.path.exists(os.path.join(rendition_path, shard_path('test_w600.jpg'))))
+
+        # 不放大图片
+        response = self.client.get(url_for('main.get_resized_image', filename='test.jpg', width=1200))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Image.open(io.BytesIO(response.get_data())).size, (1000, 500))
+        self.assertFalse(os.path.exists(os.path.join(rendition_path, shard_path('test_w1200.jpg'))))
+
+        # 宽度和已保存的尺寸相同时直接发送这个尺寸, 不生成新的文件
+        Image.new('RGB', (400, 200)).save(storage_path(current_app.config['ALBUMY_UPLOAD_PATH'], 'test_s.jpg'))
+        response = self.client.get(url_for('main.get_resized_image', filename='test.jpg', width=400))
+        self.assertEqual(Image.open(io.BytesIO(response.get_data())).size, (400, 200))
+        self.assertFalse(os.path.exists(os.path.join(rendition_path, shard_path('test_w400.jpg'))))
+
+        # 已经生成的尺寸直接从缓存发送, 不再打开原图; 记录了宽度但原图丢失时返回404
+        os.remove(storage_path(current_app.config['ALBUMY_UPLOAD_PATH'], 'test.jpg'))
+        response = self.client.get(url_for('main.get_resized_image', filename='test.jpg', width=600))
+        self.assertEqual(response.status_code, 200)
+        # 去重的图片共用同一个文件
+        Photo.query.get(1).width = 1000
+        db.session.add(Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg', width=1000))
+        db.session.commit()
+        response = self.client.get(url_for('main.get_resized_image', filename='test.jpg', width=800))
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get(url_for('main.get_resized_image', filename='test.jpg', width=601))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(url_for('main.get_resized_image', filename='nothing.jpg', width=600))
+        self.assertEqual(response.status_code, 404)
+
+    def test_rendition_cache(self):
+        rendition_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, rendition_path)
+        current_app.config['ALBUMY_RENDITION_PATH'] = rendition_path
+        current_app.config['ALBUMY_RENDITION_CACHE_SIZE'] = 250
+        app = current_app._get_current_object()
+        renders = []
+
+        def render(path):
+            renders.append(path)
+            time.sleep(0.05)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+
+        def get(name):
+            with app.app_context():
+                rendition_cache.get(name, render)
+
+        threads = [threading.Thread(target=get, args=('a.jpg',)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(renders), 1)
+
+        path_a = os.path.join(rendition_path, shard_path('a.jpg'))
+        os.utime(path_a, (time.time() - 60, time.time() - 60))
+        rendition_cache.get('b.jpg', render)
+        rendition_cache.get('c.jpg', render)
+        self.assertFalse(os.path.exists(path_a))
+        self.assertTrue(os.path.exists(os.path.join(rendition_path, shard_path('c.jpg'))))
+        # 总大小保存在缓存目录中, 其它进程累加同一个值
+        with open(os.path.join(rendition_path, '.size')) as f:
+            self.assertEqual(int(f.read()), 200)
+
     def test_explore_page(self):
         response = self.client.get(url_for('main.explore'))
         data = response.get_data(as_text=True)
         self.assertIn('换一批', data)
 
+        admin = User.query.get(1)
+        db.session.add_all([Photo(filename='%d.jpg' % i, filename_s='%d_s.jpg' % i, filename_m='%d_m.jpg' % i,
+                                  author=admin) for i in range(28)])
+        db.session.commit()
+        for photo_id in (5, 6, 7, 20):
+            db.session.delete(Photo.query.get(photo_id))
+        db.session.commit()
+
+        # 按游标加载更多, 每张图片正好出现一次
+        seen = []
+        cursor = None
+        for _ in range(5):
+            data = self.client.get(url_for('main.explore', cursor=cursor)).get_data(as_text=True)
+            photos = re.findall(r'photo/(\d+)"', data)
+            self.assertLessEqual(len(photos), 12)
+            seen.extend(photos)
+            match = re.search(r'cursor=([\w-]+)', data)
+            if match is None:
+                break
+            cursor = match.group(1)
+        self.assertEqual(sorted(seen, key=int), [str(photo.id) for photo in Photo.query.order_by(Photo.id)])
+
+        response = self.client.get(url_for('main.explore', cursor='WzEsIDJd'))
+        self.assertEqual(response.status_code, 400)
+        # 质数小于2, 不是质数, 超过当前主键的范围, 位置为负数, 或者包含bool的游标都是无效的
+        for data in ([1, 0, 1], [1, 0, 35], [1, 0, 1000003], [1, -1, 37], [1, 0, True], [True, 0, 37]):
+            response = self.client.get(url_for('main.explore', cursor=dump_cursor(data)))
+            self.assertEqual(response.status_code, 400)
+
+    def test_listing_queries(self):
+        admin = User.query.get(1)
+        User.query.get(2).follow(admin)
+        User.query.get(2).collect(Photo.query.get(1))
+        admin.collect(Photo.query.get(1))
+        self.login()
+        urls = [url_for('main.index'), url_for('main.show_tag', tag_id=1),
+                url_for('main.show_tag', tag_id=1, order='by_collects'), url_for('user.index', username='guoxy2016'),
+                url_for('main.search', q='photo'), url_for('main.search', q='user', category='user'),
+                url_for('user.show_followers', username='guoxy2016'), url_for('main.show_collectors', photo_id=1)]
+        counts = [self.count_queries(url) for url in urls]
+
+        admin = User.query.get(1)
+        tag = Tag.query.get(1)
+        for i in range(10):
+            photo = Photo(filename='%d.jpg' % i, filename_s='%d_s.jpg' % i, filename_m='%d_m.jpg' % i, author=admin,
+                          description='Photo %d' % i, tags=[tag])
+            db.session.add(Comment(body='comment', photo=photo, author=User.query.get(2)))
+            user = User(email='user%d@helloflask.com' % i, name='User %d' % i, username='user%d' % i)
+            user.follow(admin)
+            user.collect(Photo.query.get(1))
+        db.session.commit()
+        self.assertEqual([self.count_queries(url) for url in urls], counts)
+
     def test_search(self):
         response = self.client.get(url_for('main.search', q=''), follow_redirects=True)
         data = response.get_data(as_text=True)
@@ -62,6 +433,64 @@ class MainTestCase(BaseTestCase):
         self.assertNotIn('test 1', data)
         self.assertIn('test 2', data)
 
+    def test_notifications_cursor(self):
+        user = User.query.get(2)
+        db.session.add_all([Notification(message='notice %02d.' % i, receiver=user) for i in range(25)])
+        db.session.commit()
+
+        self.login()
+        response = self.client.get(url_for('main.show_notifications', filter='unread'))
+        data = response.get_data(as_text=True)
+        self.assertIn('notice 24.', data)
+        self.assertIn('notice 05.', data)
+        self.assertNotIn('notice 04.', data)
+        next_cursor = re.search(r'cursor=([\w-]+)', data).group(1)
+
+        response = self.client.get(url_for('main.show_notifications', filter='unread', cursor=next_cursor))
+        data = response.get_data(as_text=True)
+        self.assertIn('notice 04.', data)
+        self.assertIn('notice 00.', data)
+        self.assertNotIn('notice 05.', data)
+        prev_cursor = re.search(r'cursor=([\w-]+)', data).group(1)
+
+        response = self.client.get(url_for('main.show_notifications', filter='unread', cursor=prev_cursor))
+        data = response.get_data(as_text=True)
+        self.assertIn('notice 24.', data)
+        self.assertIn('notice 05.', data)
+        self.assertNotIn('notice 04.', data)
+
+    def test_aggregate_notifications(self):
+        admin, normal, locked = User.query.get(1), User.query.get(2), User.query.get(4)
+        push_collect_notification(normal, 1, admin)
+        push_collect_notification(locked, 1, admin)
+        push_follow_notification(normal, admin)
+        db.session.commit()
+        self.assertEqual(Notification.query.filter_by(receiver_id=1).count(), 2)
+        self.assertEqual(User.query.get(1).unread_notification_count, 2)
+
+        # 之后的消息和数据库中的未读消息合并, 回滚时丢弃
+        push_collect_notification(User.query.get(5), 1, User.query.get(1))
+        db.session.rollback()
+        push_collect_notification(User.query.get(4), 1, User.query.get(1))
+        db.session.commit()
+        self.assertEqual(Notification.query.filter_by(receiver_id=1, kind=Notification.COLLECT).one().count, 3)
+
+        self.login(email='admin@helloflask.com')
+        data = self.client.get(url_for('main.show_notifications')).get_data(as_text=True)
+        self.assertIn('locked_user</a>等3人收藏了你的<a href="/photo/1">图片</a>', data)
+        self.assertIn('normal_user</a>关注了你', data)
+
+        # 已读的消息不再合并
+        self.client.post(url_for('main.read_all_notification'))
+        push_collect_notification(normal, 1, User.query.get(1))
+        db.session.commit()
+        self.assertEqual(Notification.query.filter_by(receiver_id=1, kind=Notification.COLLECT).count(), 2)
+
+        db.session.delete(Photo.query.get(1))
+        db.session.commit()
+        data = self.client.get(url_for('main.show_notifications')).get_data(as_text=True)
+        self.assertIn('normal_user</a>收藏了你的图片(已删除)', data)
+
     def test_read_notification(self):
         user = User.query.get(2)
         notification1 = Notification(message='test 1', receiver=user)
@@ -81,12 +510,25 @@ class MainTestCase(BaseTestCase):
         self.assertIn('消息已读', data)
 
         self.assertTrue(Notification.query.get(1).is_read)
+        self.assertEqual(User.query.get(2).unread_notification_count, 1)
+
+        # 重复标记已读不会再减少计数
+        self.client.post(url_for('main.read_notification', notification_id=1))
+        self.assertEqual(User.query.get(2).unread_notification_count, 1)
+        response = self.client.get(url_for('ajax.notifications_count'))
+        self.assertEqual(response.get_json()['count'], 1)
+
+        db.session.delete(Notification.query.get(2))
+        db.session.commit()
+        self.assertEqual(User.query.get(2).unread_notification_count, 0)
 
     def test_read_all_notification(self):
         user = User.query.get(2)
         notification1 = Notification(message='test 1', receiver=user)
         notification2 = Notification(message='test 2', receiver=user)
-        db.session.add_all([notification1, notification2])
+        notification3 = Notification(message='test 3', receiver=user, is_read=True)
+        other = Notification(message='other', receiver=User.query.get(1))
+        db.session.add_all([notification1, notification2, notification3, other])
         db.session.commit()
 
         self.login()
@@ -97,6 +539,9 @@ class MainTestCase(BaseTestCase):
 
         self.assertTrue(Notification.query.get(1).is_read)
         self.assertTrue(Notification.query.get(2).is_read)
+        self.assertEqual(User.query.get(2).unread_notification_count, 0)
+        self.assertFalse(Notification.query.get(4).is_read)
+        self.assertEqual(User.query.get(1).unread_notification_count, 1)
 
     def test_show_photo(self):
         response = self.client.get(url_for('main.show_photo', photo_id=1), follow_redirects=True)
@@ -110,6 +555,49 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('删除', data)
 
+    def test_show_photo_threads(self):
+        # 模板中的每条评论都会检查权限, 和生产环境一样缓存角色
+        current_app.config['ALBUMY_ROLE_CACHE_TIMEOUT'] = 600
+        self.login()
+        url = url_for('main.show_photo', photo_id=1)
+        count = self.count_queries(url)
+
+        normal = User.query.get(2)
+        root = Comment.query.get(1)
+        reply = Comment(body='reply 1', photo_id=1, author=User.query.get(1), replied=root)
+        newer = Comment(body='newer comment', photo_id=1, author=normal)
+        db.session.add_all([reply, newer])
+        db.session.commit()
+        replied = reply
+        for i in range(Comment.MAX_DEPTH + 2):
+            replied = Comment(body='nested %d' % i, photo_id=1, author=User.query.get(3 + i % 3), replied=replied)
+            db.session.add(replied)
+        db.session.commit()
+        reply_id = reply.id
+
+        deepest = Comment.query.filter_by(body='nested %d' % (Comment.MAX_DEPTH + 1)).one()
+        self.assertEqual((deepest.root_id, deepest.depth), (1, Comment.MAX_DEPTH))
+        self.assertTrue(deepest.path.startswith(root.path + '/'))
+        self.assertEqual(self.count_queries(url), count)
+
+        current_app.config['ALBUMY_COMMENT_PER_PAGE'] = 100
+        data = self.client.get(url).get_data(as_text=True)
+        positions = [data.index(body) for body in ['newer comment', 'test comment body', 'reply 1', 'nested 0']]
+        self.assertEqual(positions, sorted(positions))
+
+        # 回复之后跳转到讨论串所在的页
+        current_app.config['ALBUMY_COMMENT_PER_PAGE'] = 2
+        response = self.client.post(url_for('main.new_comment', photo_id=1, reply=reply_id), data=dict(body='hi'))
+        self.assertIn('page=13', response.location)
+
+        # 插入之后再设置被回复的评论
+        comment = Comment(body='late reply', photo_id=1, author_id=2)
+        db.session.add(comment)
+        db.session.commit()
+        comment.replied = Comment.query.get(1)
+        db.session.commit()
+        self.assertEqual((comment.root_id, comment.depth), (1, 1))
+
     def test_photo_next(self):
         user = User.query.get(1)
         photo3 = Photo(filename='test.jpg', filename_s='test_s.jpg', filename_m='test_m.jpg',
@@ -177,6 +665,7 @@ class MainTestCase(BaseTestCase):
         self.assertIn('收藏成功', data)
 
         self.assertEqual(Photo.query.get(3).collectors[0].collector.name, 'Normal')
+        self.assertEqual(Photo.query.get(3).collect_count, 1)
 
         response = self.client.post(url_for('main.collect', photo_id=3), follow_redirects=True)
         data = response.get_data(as_text=True)
@@ -186,9 +675,11 @@ class MainTestCase(BaseTestCase):
         self.login()
         self.client.post(url_for('main.collect', photo_id=1), follow_redirects=True)
 
+        self.assertEqual(Photo.query.get(1).collect_count, 1)
         response = self.client.post(url_for('main.uncollect', photo_id=1), follow_redirects=True)
         data = response.get_data(as_text=True)
         self.assertIn('已取消收藏', data)
+        self.assertEqual(Photo.query.get(1).collect_count, 0)
 
         response = self.client.post(url_for('main.uncollect', photo_id=1), follow_redirects=True)
         data = response.get_data(as_text=True)
@@ -239,6 +730,7 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('已评论', data)
         self.assertEqual(Photo.query.get(1).comments[1].body, 'test comment from normal user.')
+        self.assertEqual(Photo.query.get(1).comment_count, 2)
 
     def test_new_tag(self):
         self.login(email='admin@helloflask.com')
@@ -253,6 +745,10 @@ class MainTestCase(BaseTestCase):
         self.assertEqual(Photo.query.get(1).tags[2].name, 'dog')
         self.assertEqual(Photo.query.get(1).tags[3].name, 'pet')
         self.assertEqual(Photo.query.get(1).tags[4].name, 'happy')
+        self.assertEqual([tag.photo_count for tag in Photo.query.get(1).tags], [1, 1, 1, 1, 1])
+
+        response = self.client.post(url_for('main.new_tag', photo_id=1), data=dict(tag='hello'))
+        self.assertEqual(Tag.query.filter_by(name='hello').first().photo_count, 1)
 
     def test_set_comment(self):
         self.login()
@@ -286,11 +782,18 @@ class MainTestCase(BaseTestCase):
         self.assertIn('图片已删除', data)
         self.assertIn('normal_user', data)
 
+        self.logout()
+        self.login(email='admin@helloflask.com')
+        self.client.post(url_for('main.delete_photo', photo_id=1))
+        self.assertEqual(Tag.query.get(1).photo_count, 0)
+
     def test_delete_comment(self):
         self.login()
+        self.assertEqual(Photo.query.get(1).comment_count, 1)
         response = self.client.post(url_for('main.delete_comment', comment_id=1), follow_redirects=True)
         data = response.get_data(as_text=True)
         self.assertIn('删除成功', data)
+        self.assertEqual(Photo.query.get(1).comment_count, 0)
 
     def test_show_tag(self):
         response = self.client.get(url_for('main.show_tag', tag_id=1))
@@ -301,6 +804,23 @@ class MainTestCase(BaseTestCase):
         data = response.get_data(as_text=True)
         self.assertIn('收藏量', data)
 
+    def test_show_tag_by_collects(self):
+        tag = Tag.query.get(1)
+        for i in range(15):
+            db.session.add(Photo(filename='%d.jpg' % i, filename_s='%d_s.jpg' % i, filename_m='%d_m.jpg' % i,
+                                 author=User.query.get(1), tags=[tag], collect_count=i % 4))
+        db.session.commit()
+        expected = [str(photo.id) for photo in sorted(tag.photos, key=lambda x: (x.collect_count, x.id),
+                                                      reverse=True)]
+
+        # 按收藏量对整个标签排序, 翻页时顺序不变
+        data = self.client.get(url_for('main.show_tag', tag_id=1, order='by_collects')).get_data(as_text=True)
+        first_page = re.findall(r'photo/(\d+)"', data)
+        cursor = re.search(r'cursor=([\w-]+)', data).group(1)
+        data = self.client.get(url_for('main.show_tag', tag_id=1, order='by_collects', cursor=cursor)). \
+            get_data(as_text=True)
+        self.assertEqual(first_page + re.findall(r'photo/(\d+)"', data), expected)
+
     def test_delete_tag(self):
         photo = Photo.query.get(2)
         tag = Tag(name='test')
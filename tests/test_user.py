@@ -1,7 +1,9 @@
 import io
 
-from flask import url_for
+from flask import url_for, current_app
+from flask_sqlalchemy import get_debug_queries
 
+from albumy.extensions import db, load_user
 from albumy.models import User, Photo
 from albumy.settings import Operations
 from albumy.utils import generate_token
@@ -10,6 +12,29 @@ from .base import BaseTestCase
 
 class UserTestCase(BaseTestCase):
 
+    def test_load_user_snapshot(self):
+        current_app.config['ALBUMY_USER_CACHE_TIMEOUT'] = 60
+        current_app.config['ALBUMY_ROLE_CACHE_TIMEOUT'] = 600
+        db.session.expunge_all()
+        load_user('2')
+        User.query.get(1).can('UPLOAD')
+        db.session.expunge_all()
+        start = len(get_debug_queries())
+        user = load_user('2')
+        self.assertEqual(user.username, 'normal_user')
+        self.assertTrue(user.can('UPLOAD'))
+        self.assertFalse(user.is_admin)
+        self.assertEqual(len(get_debug_queries()) - start, 0)
+        # 快照之外的字段在访问时加载
+        self.assertEqual(user.email, 'normal@helloflask.com')
+        self.assertIsNone(load_user('100'))
+
+        user.lock()
+        db.session.expunge_all()
+        user = load_user('2')
+        self.assertTrue(user.locked)
+        self.assertFalse(user.can('UPLOAD'))
+
     def test_index_page(self):
         response = self.client.get(url_for('user.index', username='normal_user'))
         data = response.get_data(as_text=True)